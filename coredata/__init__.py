@@ -1,3 +1,16 @@
 """ Import packages here for visability. """
 
-from .coredata import CoredataClient, Entity, CoredataError
+from .coredata import CoredataClient, Entity, CoredataError, CoredataTimeout
+from .transport import (
+    Transport, RequestsTransport, HTTP2Transport, TransportRegistry,
+    SharedTransport)
+from .stats import ClientStats
+from .crawler import Crawler
+from .streaming import PageParser
+from .interning import Interner, FrozenDict
+from .auth import TokenAuth, SessionCookie
+from .cache import BlobCache
+from .migration import Migration, MigrationError, Ref
+from .spool import SpooledListing
+from .watcher import Watcher, Event
+from .profiling import Profile
@@ -0,0 +1,142 @@
+""" Session token authentication for the Coredata client. """
+
+import threading
+
+from .throttle import clock
+try:
+    # Python3
+    from http.cookies import SimpleCookie
+    from urllib.parse import urljoin
+except ImportError:
+    # Python2
+    from Cookie import SimpleCookie
+    from urlparse import urljoin
+
+
+class SessionCookie(object):
+
+    """
+    Fetch a token by logging in and keeping the session cookie.
+
+    Makes a basic auth GET to ``path`` under the API root and uses the
+    ``name`` cookie the server sets as the token. The token expires after the
+    cookie's ``max-age``, or ``ttl`` seconds if it has none. The login
+    gets the timeout of the client's requests, or ``timeout`` seconds if
+    the client has none.
+    """
+
+    def __init__(self, path='user/', name='sessionid', ttl=3600, timeout=30):
+        """ Initialize the fetcher. """
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def __call__(self, client, username, password):
+        """ Log in and return the cookie header and its expiry time. """
+        url = urljoin(client.host, self.path)
+        # Other callers wait for the login, so it must not hang.
+        r = client.transport.request(
+            'GET', url, auth=(username, password), headers=client.headers,
+            timeout=client._timeout() or self.timeout)
+        if not r.ok:
+            return None
+        cookies = SimpleCookie()
+        cookies.load(r.headers.get('set-cookie', ''))
+        if self.name not in cookies:
+            return None
+        morsel = cookies[self.name]
+        max_age = morsel['max-age']
+        expires = clock() + (int(max_age) if max_age else self.ttl)
+        return {'cookie': '{name}={value}'.format(
+            name=self.name, value=morsel.value)}, expires
+
+
+class TokenAuth(object):
+
+    """
+    Exchange credentials once for a session token and reuse it.
+
+    Pass an instance as the ``auth`` of a :class:`~coredata.CoredataClient`.
+    The token is fetched on the first request and then sent instead of the
+    credentials. It is refreshed ``refresh_margin`` seconds before it
+    expires by a single thread while the others keep using the current one.
+    When no token can be fetched, or the server rejects it, requests fall
+    back to basic auth and a new token is tried after ``retry_after``
+    seconds.
+
+    :param fetch_token: Called with the client, username and password to
+        get a token. Returns a tuple of the headers that authenticate a
+        request and the :func:`~coredata.throttle.clock` time the token
+        expires, or None. Defaults to :class:`SessionCookie`.
+    """
+
+    def __init__(self, username, password, fetch_token=None,
+                 refresh_margin=60, retry_after=60):
+        """ Initialize the authentication without a token. """
+        self.username = username
+        self.password = password
+        self.fetch_token = fetch_token or SessionCookie()
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._token = None
+        self._retry_at = 0
+
+    @property
+    def basic(self):
+        """ The credentials for basic auth. """
+        return self.username, self.password
+
+    def __getstate__(self):
+        """ Pickle the credentials but not the lock or the token. """
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_token'] = None
+        return state
+
+    def __setstate__(self, state):
+        """ Restore the credentials with a new lock. """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def headers(self, client):
+        """ Return the headers that authenticate a request or None. """
+        token = self._token
+        now = clock()
+        if token is None or now >= token[1]:
+            # Without a valid token every caller waits for the refresh.
+            with self._lock:
+                token = self._token
+                if token is None or clock() >= token[1]:
+                    token = self._refresh(client)
+        elif now >= token[1] - self.refresh_margin and \
+                self._lock.acquire(False):
+            # Only one caller refreshes an expiring token, the others keep
+            # using it.
+            try:
+                token = self._refresh(client) or token
+            finally:
+                self._lock.release()
+        return token[0] if token else None
+
+    def _refresh(self, client):
+        """ Fetch a new token, the lock must be held. """
+        if clock() < self._retry_at:
+            return None
+        try:
+            token = self.fetch_token(client, self.username, self.password)
+        except Exception:
+            token = None
+        if token is None:
+            self._retry_at = clock() + self.retry_after
+        else:
+            self._token = token
+        return token
+
+    def invalidate(self, headers):
+        """ Drop the token in ``headers`` after the server refused it. """
+        with self._lock:
+            if self._token is not None and self._token[0] == headers:
+                self._token = None
+                self._retry_at = clock() + self.retry_after
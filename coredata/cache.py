@@ -0,0 +1,133 @@
+""" A content addressed cache of file contents on disk. """
+
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+DIGEST = re.compile(r'^[0-9a-fA-F]{8,128}$')
+
+# The hash algorithms of hex digests by their length.
+ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+class BlobCache(object):
+
+    """
+    Keep file contents on disk under the ``digest`` of the file.
+
+    The cache holds at most ``max_size`` bytes and evicts the least recently
+    used blobs when it grows larger. Blobs are opened as read only memory
+    maps, so large files can be read without copying them into memory.
+    Several caches, and processes, may share a directory.
+
+    Blobs are checked against digests that look like a MD5, SHA-1, SHA-256
+    or SHA-512 hex digest, by their length, before they are stored.
+    """
+
+    def __init__(self, directory, max_size=1 << 30):
+        """ Initialize the cache and index the blobs already in it. """
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        blobs = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if DIGEST.match(name):
+                    stat = os.stat(os.path.join(root, name))
+                    blobs.append((stat.st_atime, name, stat.st_size))
+        for _, digest, size in sorted(blobs):
+            self._blobs[digest] = size
+            self.size += size
+
+    def path(self, digest):
+        """ Return the path of the blob with ``digest``. """
+        if not DIGEST.match(digest):
+            raise ValueError('Invalid digest: {digest}'.format(digest=digest))
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def __contains__(self, digest):
+        """ Check if the cache has the blob with ``digest``. """
+        return digest in self._blobs
+
+    def __len__(self):
+        """ Return the number of blobs in the cache. """
+        return len(self._blobs)
+
+    def open(self, digest):
+        """ Return a memory map of the blob with ``digest`` or None. """
+        path = self.path(digest)
+        with self._lock:
+            if digest not in self._blobs:
+                return None
+            # Mark the blob as the most recently used.
+            self._blobs[digest] = self._blobs.pop(digest)
+        try:
+            with open(path, 'rb') as f:
+                os.utime(path, None)
+                if not os.fstat(f.fileno()).st_size:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            # Removed by another cache that shares the directory.
+            with self._lock:
+                self.size -= self._blobs.pop(digest, 0)
+            return None
+
+    def put(self, digest, chunks):
+        """
+        Store the blob with ``digest`` from an iterable of chunks.
+
+        Raises ValueError, and stores nothing, if the chunks do not match
+        the digest.
+        """
+        path = self.path(digest)
+        algorithm = ALGORITHMS.get(len(digest))
+        hash = hashlib.new(algorithm) if algorithm else None
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread in the meantime.
+                pass
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    if hash is not None:
+                        hash.update(chunk)
+            if hash is not None and hash.hexdigest() != digest.lower():
+                raise ValueError(
+                    'Content does not match digest {digest}'.format(
+                        digest=digest))
+            os.rename(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        with self._lock:
+            self.size += size - self._blobs.pop(digest, 0)
+            self._blobs[digest] = size
+            self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used blobs, the lock must be held. """
+        # The newest blob is kept, even if it is larger than the cache.
+        while self.size > self.max_size and len(self._blobs) > 1:
+            digest, size = self._blobs.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
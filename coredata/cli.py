@@ -0,0 +1,211 @@
+r"""
+The ``coredata`` command line tool.
+
+Export a listing to NDJSON, one object per line::
+
+    coredata export files --filter title__startswith=Y -o files.ndjson.gz
+
+Import NDJSON by creating objects::
+
+    coredata import files -i files.ndjson.gz --concurrency 16 --rate 50 \
+        --failures failed.ndjson
+
+With ``--mode edit`` the objects are edited by their id instead, and with
+``--mode auto`` objects that have an id are edited and the rest created.
+Exported objects all have ids, so only use ``auto`` to import them into the
+instance they came from.
+
+Lines that fail to import are written to the failures file, which can be
+imported again to resume. The host and credentials are read from the
+``COREDATA_HOST``, ``COREDATA_USERNAME`` and ``COREDATA_PASSWORD``
+environment variables unless they are given as options.
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from .coredata import CoredataClient, CoredataError, Entity
+from .throttle import RateLimiter
+
+
+def open_ndjson(path, mode):
+    """ Open a NDJSON file, '-' for stdin or stdout, gzipped if .gz. """
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.open(stream.fileno(), mode, encoding='utf-8', closefd=False)
+    elif path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+def search_term(term):
+    """ Parse a 'key=value' search term. """
+    key, sep, value = term.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'Filters should look like key=value, got {term}'.format(
+                term=term))
+    return key, value
+
+
+class Progress(object):
+
+    """ Count processed objects and report the progress on stderr. """
+
+    def __init__(self, every, stream=None):
+        """ Report every ``every`` objects, never if it is 0. """
+        self.every = every
+        self.stream = stream or sys.stderr
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, failed=False):
+        """ Count an object. """
+        with self.lock:
+            self.done += 1
+            self.failed += failed
+            if self.every and self.done % self.every == 0:
+                self.report()
+
+    def report(self):
+        """ Write the progress to the stream. """
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.stream.write(
+            '{done} done, {failed} failed, {rate:.1f}/s\n'.format(
+                done=self.done, failed=self.failed,
+                rate=self.done / elapsed))
+
+
+def export(client, args):
+    """ Stream a listing to NDJSON. """
+    progress = Progress(args.progress)
+    terms = dict(args.filter or [])
+    with open_ndjson(args.output, 'w') as f:
+        for obj in client.iter_objects(
+                Entity(args.entity), limit=args.page_size,
+                search_terms=terms):
+            f.write(json.dumps(obj, ensure_ascii=False) + u'\n')
+            progress.add()
+    progress.report()
+    return 0
+
+
+def import_(client, args):
+    """ Create or edit the objects in a NDJSON file in parallel. """
+    entity = Entity(args.entity)
+    progress = Progress(args.progress)
+    limiter = RateLimiter(args.rate)
+    # Keep a bounded number of lines in flight so memory stays flat.
+    in_flight = threading.BoundedSemaphore(args.concurrency * 2)
+    failures = open_ndjson(args.failures, 'w') if args.failures else None
+    failures_lock = threading.Lock()
+
+    def write(line):
+        limiter.acquire()
+        obj = json.loads(line)
+        if args.mode == 'edit' or (args.mode == 'auto' and obj.get('id')):
+            r = client.edit(entity, obj['id'], obj)
+            if not r.ok:
+                raise CoredataError(
+                    'Error occured! Status code is {code} for {id}'.format(
+                        code=r.status_code, id=obj['id']))
+        else:
+            client.create(entity, obj)
+
+    def run(line):
+        try:
+            write(line)
+        except Exception as e:
+            sys.stderr.write('Failed: {error}\n'.format(error=e))
+            if failures:
+                with failures_lock:
+                    failures.write(line.rstrip(u'\n') + u'\n')
+            progress.add(failed=True)
+        else:
+            progress.add()
+        finally:
+            in_flight.release()
+
+    pool = ThreadPool(args.concurrency)
+    try:
+        with open_ndjson(args.input, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                in_flight.acquire()
+                pool.apply_async(run, (line,))
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if failures:
+            failures.close()
+    progress.report()
+    return 1 if progress.failed else 0
+
+
+def parser():
+    """ Create the argument parser of the tool. """
+    entities = [entity.value for entity in Entity]
+    p = argparse.ArgumentParser(
+        prog='coredata', description='Export and import Coredata objects.')
+    p.add_argument('--host', default=os.environ.get('COREDATA_HOST'))
+    p.add_argument('--username', default=os.environ.get('COREDATA_USERNAME'))
+    p.add_argument('--password', default=os.environ.get('COREDATA_PASSWORD'))
+    p.add_argument('--progress', type=int, default=1000, metavar='N',
+                   help='Report progress every N objects, 0 to disable.')
+    commands = p.add_subparsers(dest='command')
+    commands.required = True
+
+    e = commands.add_parser('export', help='Export a listing to NDJSON.')
+    e.add_argument('entity', choices=entities)
+    e.add_argument('--filter', action='append', type=search_term,
+                   metavar='KEY=VALUE',
+                   help='Search terms, may be given more than once.')
+    e.add_argument('-o', '--output', default='-',
+                   help='The NDJSON file, gzipped if it ends with .gz.')
+    e.add_argument('--page-size', type=int, default=100)
+    e.set_defaults(run=export)
+
+    i = commands.add_parser('import', help='Import objects from NDJSON.')
+    i.add_argument('entity', choices=entities)
+    i.add_argument('-i', '--input', default='-',
+                   help='The NDJSON file, gzipped if it ends with .gz.')
+    i.add_argument('--mode', choices=['create', 'edit', 'auto'],
+                   default='create',
+                   help='auto edits objects that have an id and creates '
+                        'the rest, only use it to import into the instance '
+                        'that was exported.')
+    i.add_argument('--concurrency', type=int, default=8)
+    i.add_argument('--rate', type=float, default=None,
+                   help='The most requests per second.')
+    i.add_argument('--failures', metavar='FILE',
+                   help='Write lines that fail here to import them again.')
+    i.set_defaults(run=import_)
+    return p
+
+
+def main(argv=None):
+    """ Run the command line tool and return the exit code. """
+    args = parser().parse_args(argv)
+    if not args.host or not args.username:
+        sys.stderr.write('A host and a username are required.\n')
+        return 2
+    client = CoredataClient(args.host, (args.username, args.password))
+    try:
+        return args.run(client, args)
+    finally:
+        client.transport.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
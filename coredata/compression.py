@@ -0,0 +1,44 @@
+""" Content encodings the client can use for responses and payloads. """
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def available_encodings(decoded=None):
+    """
+    Return the content encodings supported by the installed packages.
+
+    ``decoded`` limits them to the encodings that a transport decodes.
+    """
+    encodings = ['gzip']
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    if decoded is not None:
+        encodings = [encoding for encoding in encodings
+                     if encoding in decoded]
+    return encodings
+
+
+def compress(data, encoding):
+    """ Compress ``data`` with the given content encoding. """
+    if isinstance(data, type(u'')):
+        data = data.encode('utf-8')
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'br' and brotli is not None:
+        return brotli.compress(data)
+    elif encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError('Unsupported content encoding: {encoding}'.format(
+        encoding=encoding))
@@ -1,17 +1,37 @@
 """ Coredata REST api python library. """
 
 import json
-import requests
+import threading
 
+from contextlib import contextmanager
 from enum import Enum
+from multiprocessing.pool import ThreadPool
+from .auth import TokenAuth
+from .compression import available_encodings, compress
+from .profiling import NullProfile, Profile
+from .spool import SpooledListing
+from .stats import ClientStats, LatencyTracker
+from .streaming import PageParser
+from .throttle import clock
+from .transport import (
+    BufferedResponse, SharedTransport, TransportTimeout, registry)
 try:
     # Python3
-    from urllib.parse import urlencode, urljoin, urlsplit, urlunsplit, parse_qs
+    from queue import Queue, Empty
+    from urllib.parse import (
+        urlencode, urljoin, urlsplit, urlunsplit, parse_qs, quote)
 except ImportError:
     # Python2
-    from urllib import urlencode
+    from Queue import Queue, Empty
+    from urllib import urlencode, quote
     from urlparse import urljoin, urlsplit, urlunsplit, parse_qs
 
+# Most proxies and servers accept at least this many characters in a URL.
+MAX_URL_LENGTH = 2000
+
+# Marks the end of the objects of a page, which may contain null.
+_END = object()
+
 
 class CoredataError(Exception):
 
@@ -20,6 +40,13 @@ class CoredataError(Exception):
     pass
 
 
+class CoredataTimeout(CoredataError):
+
+    """ Raised when a request or a deadline runs out of time. """
+
+    pass
+
+
 class Entity(Enum):
 
     """ A list of Coredata endpoints listed as a enumerate. """
@@ -53,33 +80,437 @@ class Utils:
         scheme, netloc, path, query_string, fragment = urlsplit(url)
         query = parse_qs(query_string)
         query.update(parameters)
-        return urlunsplit((scheme, netloc, path, urlencode(query), fragment))
+        return urlunsplit(
+            (scheme, netloc, path, urlencode(query, doseq=True), fragment))
+
+    @staticmethod
+    def plain(value):
+        """ Return a value with its tuples turned into lists, recursively. """
+        if isinstance(value, (list, tuple)):
+            return [Utils.plain(item) for item in value]
+        if isinstance(value, dict):
+            return dict((key, Utils.plain(item))
+                        for key, item in value.items())
+        return value
+
+    @staticmethod
+    def changed_fields(original, modified):
+        """
+        Return the top level fields that differ between two objects.
+
+        Fields that were removed from ``modified`` are set to None.
+        """
+        changes = dict(
+            (key, value) for key, value in modified.items()
+            if key not in original or
+            Utils.plain(original[key]) != Utils.plain(value))
+        for key in original:
+            if key not in modified:
+                changes[key] = None
+        return changes
+
+
+class Pagination:
+
+    """
+    Work out the URLs of the pages in a listing.
+
+    The next page is the one the server links to in ``meta``. A keyset
+    cursor in ``meta.next_cursor`` is preferred over the ``meta.next`` link,
+    which is followed verbatim. Query terms that the server leaves out of the
+    link, such as filters, are carried forward so every page of a filtered
+    listing stays filtered.
+    """
+
+    def __init__(self, host, url, terms):
+        """ Initialize the pagination of the listing at ``url``. """
+        self.host = host
+        self.url = url
+        self.terms = terms
+
+    def first(self):
+        """ Return the URL of the first page. """
+        return Utils.add_url_parameters(self.url, self.terms)
+
+    def next(self, meta):
+        """ Return the URL of the page after the one with ``meta`` or None. """
+        cursor = meta.get('next_cursor')
+        if cursor:
+            terms = dict(self.terms, cursor=cursor)
+            terms.pop('offset', None)
+            return Utils.add_url_parameters(self.url, terms)
+        next_path = meta.get('next')
+        if not next_path:
+            return None
+        url = urljoin(self.host, next_path)
+        query = parse_qs(urlsplit(url).query)
+        missing = dict((key, value) for key, value in self.terms.items()
+                       if key not in query)
+        return Utils.add_url_parameters(url, missing) if missing else url
 
 
 class CoredataClient:
 
     """ A thin wrapper for requests to talk to the CoreData API. """
 
-    def __init__(self, host, auth):
-        """ Initialize the Coredata client. """
+    def __init__(self, host, auth, transport=None, compression=None,
+                 compress_requests=None, interner=None, blob_cache=None,
+                 timeout=None, hedge_percentile=None, count_ttl=30,
+                 digest_ttl=0):
+        """
+        Initialize the Coredata client.
+
+        :param auth: A (username, password) tuple for basic auth or a
+            :class:`~coredata.auth.TokenAuth` to authenticate with a cached
+            session token.
+        :param transport: The :class:`~coredata.transport.Transport` used to
+            make requests. Defaults to the HTTP/1.1 connection pool of the
+            host in the process wide :data:`~coredata.transport.registry`.
+        :param compression: The content encodings to accept for responses,
+            e.g. ``['zstd', 'gzip']``, or True to accept every encoding that
+            the transport decodes. :class:`ValueError` is raised for an
+            encoding that the transport does not decode.
+        :param compress_requests: The content encoding used to compress
+            request payloads, e.g. ``'gzip'``.
+        :param interner: An :class:`~coredata.interning.Interner` that the
+            objects of listings are passed through to share repeated values.
+        :param blob_cache: A :class:`~coredata.cache.BlobCache` that file
+            contents are downloaded into and read from.
+        :param timeout: The most seconds a request may wait to connect or
+            for data before :class:`CoredataTimeout` is raised.
+        :param hedge_percentile: Hedge GET requests that take longer than
+            this percentile of recent latencies, e.g. 95, by sending the same
+            request again and using whichever response comes first.
+        :param count_ttl: The seconds that the results of :meth:`count` are
+            cached for.
+        :param digest_ttl: The seconds that the digest of a file is
+            remembered for, so its content is read from the ``blob_cache``
+            again without asking for the digest. Digests are not remembered
+            by default, as a file may be changed by other clients.
+        """
         # TODO: Parse the url rather than checking here.
         if 'http' not in host:
             raise ValueError('Missing scheme from host.')
         self.auth = auth
         self.host = urljoin(host, '/api/v2/')
         self.headers = {'content-type': 'application/json'}
+        self.transport = transport or SharedTransport(registry)
+        self.stats = ClientStats()
+        if compression:
+            # Only accept what the transport decodes before r.json().
+            decoded = available_encodings(
+                self.transport.decoded_encodings(self.host))
+            if compression is True:
+                compression = decoded
+            for encoding in compression:
+                if encoding not in decoded:
+                    raise ValueError(
+                        'Unsupported content encoding: {encoding}'.format(
+                            encoding=encoding))
+            self.headers['accept-encoding'] = ', '.join(compression)
+        if compress_requests and \
+                compress_requests not in available_encodings():
+            raise ValueError('Unsupported content encoding: {encoding}'.format(
+                encoding=compress_requests))
+        self.compress_requests = compress_requests
+        self.interner = interner
+        self.blob_cache = blob_cache
+        self.timeout = timeout
+        self.latencies = None
+        if hedge_percentile:
+            self.latencies = LatencyTracker(hedge_percentile)
+        self._local = threading.local()
+        # Whether the server honours ``id__in`` filters. None until probed.
+        self.supports_id_in = None
+        # Whether the server accepts PATCH requests. None until tried.
+        self.supports_patch = None
+        self.count_ttl = count_ttl
+        self.profiler = NullProfile()
+        # Counts and the time they expire by filter.
+        self._counts = {}
+        self._counts_lock = threading.Lock()
+        self._counts_pruned = clock()
+        self.digest_ttl = digest_ttl
+        # Digests of files and the time they expire by id.
+        self._digests = {}
+        self._digests_lock = threading.Lock()
+        self._digests_pruned = clock()
+
+    def _request(self, method, url, data=None, stream=False):
+        """ Make a request to Coredata through the transport. """
+        headers = self.headers
+        if data is not None:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.stats.incr('bytes_sent', len(data))
+            if self.compress_requests:
+                data = compress(data, self.compress_requests)
+                headers = dict(
+                    headers, **{'content-encoding': self.compress_requests})
+            self.stats.incr('bytes_sent_wire', len(data))
+        timeout = self._timeout()
+        # The timeout applies to every read, so within a deadline the body
+        # is streamed and the deadline checked between the chunks.
+        read_stream = not stream and \
+            bool(getattr(self._local, 'deadlines', None))
+        with self.profiler.phase('network', url):
+            if method == 'GET' and self.latencies is not None:
+                r = self._hedge(url, headers, stream or read_stream, timeout)
+            else:
+                r = self._send(method, url, headers, data,
+                               stream or read_stream, timeout)
+            if read_stream:
+                r = BufferedResponse(r, self._read_within_deadline(r))
+            if not stream:
+                # Read the whole body while the network is timed.
+                content = r.content
+        self.stats.incr('requests')
+        if not stream:
+            self.stats.incr('bytes_received', len(content))
+            self.stats.incr(
+                'bytes_received_wire', self.transport.received_bytes(r))
+        return r
+
+    def _read_within_deadline(self, r):
+        """ Read the body of a streamed response before the deadline. """
+        chunks = []
+        try:
+            for chunk in r.iter_content(1 << 16):
+                chunks.append(chunk)
+                self._remaining()
+        except BaseException:
+            r.close()
+            raise
+        return b''.join(chunks)
+
+    def _send(self, method, url, headers, data, stream, timeout):
+        """ Authenticate and send a request through the transport. """
+        auth, token, request_headers = self.auth, None, headers
+        if isinstance(self.auth, TokenAuth):
+            token = self.auth.headers(self)
+            auth = None if token else self.auth.basic
+            if token:
+                request_headers = dict(headers, **token)
+        started = clock()
+        try:
+            r = self.transport.request(
+                method, url, auth=auth, headers=request_headers, data=data,
+                stream=stream, timeout=timeout)
+            if token and r.status_code == 401:
+                # The token was refused, try again with the credentials and
+                # the headers of this request without the token.
+                self.auth.invalidate(token)
+                r.close()
+                r = self.transport.request(
+                    method, url, auth=self.auth.basic, headers=headers,
+                    data=data, stream=stream, timeout=timeout)
+        except TransportTimeout as e:
+            self.stats.incr('timeouts')
+            raise CoredataTimeout('Timed out: {error} for {url}'.format(
+                error=e, url=url))
+        if self.latencies is not None and method == 'GET' and r.ok:
+            self.latencies.add(clock() - started)
+        return r
+
+    def _hedge(self, url, headers, stream, timeout):
+        """
+        Send a GET and send it again if it is slower than usual.
+
+        The first response that arrives is returned and the other one is
+        closed when it arrives.
+        """
+        delay = self.latencies.threshold()
+        if delay is None:
+            return self._send('GET', url, headers, None, stream, timeout)
+        results = Queue()
+
+        def attempt(number):
+            try:
+                r = self._send('GET', url, headers, None, stream, timeout)
+                results.put((number, r, None))
+            except Exception as e:
+                results.put((number, None, e))
+
+        def start(number):
+            thread = threading.Thread(target=attempt, args=(number,))
+            thread.daemon = True
+            thread.start()
+
+        def close_losers(count):
+            # Close the slower responses whenever they arrive.
+            for i in range(count):
+                loser = results.get()[1]
+                if loser is not None:
+                    loser.close()
+
+        start(0)
+        attempts, received = 1, 0
+        try:
+            remaining = self._remaining()
+            if remaining is not None:
+                delay = min(delay, remaining)
+            try:
+                result = results.get(timeout=delay)
+            except Empty:
+                # Do not hedge once the deadline has passed.
+                self._remaining()
+                self.stats.incr('hedged_requests')
+                start(1)
+                attempts = 2
+                result = self._wait(results)
+            received = 1
+            # If the first attempt failed, wait for the other one.
+            while result[2] is not None and received < attempts:
+                result = self._wait(results)
+                received += 1
+        finally:
+            if received < attempts:
+                thread = threading.Thread(
+                    target=close_losers, args=(attempts - received,))
+                thread.daemon = True
+                thread.start()
+        number, r, error = result
+        if error is not None:
+            raise error
+        if number == 1:
+            self.stats.incr('hedge_wins')
+        return r
+
+    def _remaining(self):
+        """
+        Return the seconds left until the current deadline, or None.
+
+        Raises :class:`CoredataTimeout` if the deadline has passed.
+        """
+        deadlines = getattr(self._local, 'deadlines', None)
+        if not deadlines:
+            return None
+        remaining = min(deadlines) - clock()
+        if remaining <= 0:
+            self.stats.incr('timeouts')
+            raise CoredataTimeout('The deadline has passed.')
+        return remaining
+
+    def _wait(self, results):
+        """ Return the next item of a queue within the current deadline. """
+        try:
+            return results.get(timeout=self._remaining())
+        except Empty:
+            self.stats.incr('timeouts')
+            raise CoredataTimeout('The deadline has passed.')
+
+    def _timeout(self):
+        """ Return the timeout for a request within the current deadline. """
+        remaining = self._remaining()
+        if remaining is None:
+            return self.timeout
+        return min(remaining, self.timeout or remaining)
+
+    def _with_deadlines(self, function):
+        """ Wrap a function to run within this thread's deadlines. """
+        deadlines = list(getattr(self._local, 'deadlines', ()))
+
+        def call(*args):
+            previous = getattr(self._local, 'deadlines', None)
+            self._local.deadlines = deadlines
+            try:
+                return function(*args)
+            finally:
+                self._local.deadlines = previous
+        return call
+
+    @contextmanager
+    def profile(self, trace_memory=False, slowest=10):
+        """
+        Profile the requests made in a block and yield the profile.
+
+        See :class:`~coredata.profiling.Profile` for what is recorded.
+        """
+        profile = Profile(trace_memory=trace_memory, slowest=slowest)
+        previous, self.profiler = self.profiler, profile
+        profile.start()
+        try:
+            yield profile
+        finally:
+            self.profiler = previous
+            profile.stop()
+
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Limit all the requests in a block to ``seconds`` in total.
+
+        Every request made in the block, for example all the pages of a
+        :meth:`get`, gets a timeout of the time that remains and
+        :class:`CoredataTimeout` is raised when it runs out::
+
+            with client.deadline(30):
+                files = client.get(Entity.Files)
+
+        Deadlines apply to the thread that enters the block, and to the
+        threads that :meth:`get_many` and :meth:`aggregate` use for it, and
+        can be nested, the earliest one counts.
+        """
+        if not hasattr(self._local, 'deadlines'):
+            self._local.deadlines = []
+        self._local.deadlines.append(clock() + seconds)
+        try:
+            yield
+        finally:
+            self._local.deadlines.pop()
 
     def edit(self, entity, id, payload, sync=True):
-        """ Edit a document. """
+        """ Edit a document and return the response. """
+        url = urljoin(self.host, entity.value + '/')
+        url = urljoin(url, id + '/')
+        params = {'sync': str(sync).lower()}
+        url = Utils.add_url_parameters(url, params)
+        if entity == Entity.Files:
+            self._forget_digest(id)
+        r = self._request('PUT', url, data=json.dumps(payload))
+        if r.status_code == 500:
+            error_message = r.json()['error_message']
+            raise CoredataError('Error! {error}'.format(error=error_message))
+        return r
+
+    def edit_changes(self, entity, id, original, modified, sync=True):
+        """
+        Edit a document by sending only the fields that changed.
+
+        ``original`` is the document as it was fetched and ``modified`` the
+        edited copy. The changed fields are sent with a PATCH, or with a PUT
+        of just those fields if the server does not allow PATCH, and
+        returned. No request is made when nothing changed.
+        """
+        changes = Utils.changed_fields(original, modified)
+        if not changes:
+            self.stats.incr('edits_skipped')
+            return changes
         url = urljoin(self.host, entity.value + '/')
         url = urljoin(url, id + '/')
         params = {'sync': str(sync).lower()}
         url = Utils.add_url_parameters(url, params)
-        r = requests.put(url, auth=self.auth, data=json.dumps(payload),
-                         headers=self.headers)
+        data = json.dumps(changes)
+        if entity == Entity.Files:
+            self._forget_digest(id)
+        r = None
+        if self.supports_patch is not False:
+            r = self._request('PATCH', url, data=data)
+            if r.status_code in (405, 501):
+                self.supports_patch = False
+                r = None
+            elif r.ok:
+                self.supports_patch = True
+        if r is None:
+            r = self._request('PUT', url, data=data)
         if r.status_code == 500:
             error_message = r.json()['error_message']
             raise CoredataError('Error! {error}'.format(error=error_message))
+        elif not r.ok:
+            raise CoredataError(
+                'Error occured! Status code is {code} for {url}'.format(
+                    code=r.status_code, url=url))
+        return changes
 
     def delete(self, entity, id, sync=True):
         """ Delete a document. """
@@ -87,7 +518,9 @@ class CoredataClient:
         url = urljoin(url, id + '/')
         params = {'sync': str(sync).lower()}
         url = Utils.add_url_parameters(url, params)
-        r = requests.delete(url, auth=self.auth, headers=self.headers)
+        if entity == Entity.Files:
+            self._forget_digest(id)
+        r = self._request('DELETE', url)
         if r.status_code == 500:
             error_message = r.json()['error_message']
             raise CoredataError('Error! {error}'.format(error=error_message))
@@ -102,8 +535,7 @@ class CoredataClient:
 
         # Make a post request with the payload to the appropriate entity
         # endpoint
-        r = requests.post(url, auth=self.auth, data=json.dumps(payload),
-                          headers=self.headers)
+        r = self._request('POST', url, data=json.dumps(payload))
 
         if r.status_code == 500:
             error_message = r.json()['error_message']
@@ -112,12 +544,24 @@ class CoredataClient:
         return r.headers['location'].rsplit('/', 1)[1]
 
     def get(self, entity, id=None, sub_entity=None, offset=0, limit=20,
-            search_terms=None, sync=True):
+            search_terms=None, sync=True, spool=None):
         """
         Get all entities that fufill the given filtering if provided.
 
+        :param spool: Write the objects to disk as the pages come in and
+            return a :class:`~coredata.spool.SpooledListing` instead of a
+            list. Either True for a temporary file or the path of the file.
         :todo: Rename search_terms
         """
+        if entity == Entity.Files and sub_entity == Entity.Content and \
+                self.blob_cache is not None:
+            blob = self.get_content(id, sync=sync)
+            if isinstance(blob, bytes):
+                return blob
+            try:
+                return blob[:]
+            finally:
+                blob.close()
         url = urljoin(self.host, entity.value + '/')
         url = urljoin(url, id + '/') if id else url
         url = urljoin(url, sub_entity.value + '/') if sub_entity else url
@@ -126,34 +570,400 @@ class CoredataClient:
             terms.update(search_terms)
         if not id:
             terms.update({'limit': limit, 'offset': offset})
-        url = Utils.add_url_parameters(url, terms)
-        r = requests.get(url, auth=self.auth, headers=self.headers)
-        if sub_entity == Entity.Content:
-            return r.content
-        elif r.ok:
-            j = r.json()
-
+        with self.profiler.phase('url'):
+            pages = Pagination(self.host, url, terms)
+            url = pages.first()
+        with self.profiler.page(url):
+            r = self._request('GET', url)
+            if sub_entity == Entity.Content:
+                return r.content
+            elif r.ok:
+                with self.profiler.phase('decode'):
+                    j = r.json()
+                    if 'meta' in j and not spool:
+                        self._intern(j['objects'])
+        if r.ok:
             if 'meta' not in j:
                 # TODO: Fix error in API. No meta data returned when getting a
                 # single object.
                 return {'objects': [j]}
 
-            next_path = j['meta']['next']
-
-            while next_path:
-                offset += limit
-                url = urljoin(self.host, entity.value + '/')
-                url = urljoin(url, id + '/') if id else url
-                url = urljoin(
-                    url, sub_entity.value + '/') if sub_entity else url
-                terms = {'offset': offset}
-                url = Utils.add_url_parameters(
-                    url, {'offset': offset})
-                r = requests.get(url, auth=self.auth, headers=self.headers)
-                j['objects'].extend(r.json()['objects'])
-                next_path = r.json()['meta']['next']
-
-            return j['objects']
+            if spool:
+                objects = SpooledListing(None if spool is True else spool)
+                objects.extend(j['objects'])
+            else:
+                objects = j['objects']
+            with self.profiler.phase('url'):
+                url = pages.next(j['meta'])
+
+            try:
+                while url:
+                    with self.profiler.page(url):
+                        r = self._request('GET', url)
+                        if not r.ok:
+                            raise CoredataError(
+                                'Error occured! Status code is {code} for '
+                                '{url}'.format(code=r.status_code, url=url))
+                        with self.profiler.phase('decode'):
+                            j = r.json()
+                            objects.extend(j['objects'] if spool
+                                           else self._intern(j['objects']))
+                    with self.profiler.phase('url'):
+                        url = pages.next(j['meta'])
+            except Exception:
+                if spool:
+                    objects.close()
+                raise
+
+            return objects
+        else:
+            raise CoredataError(
+                'Error occured! Status code is {code} for {url}'.format(
+                    code=r.status_code, url=url))
+
+    def get_content(self, id, digest=None, sync=True):
+        """
+        Get the content of a file through the blob cache.
+
+        The content is looked up in the cache by the ``digest`` of the file,
+        which is fetched if it is not given or remembered, and only
+        downloaded when it is not there. Content that does not match its
+        digest is not cached and raises :class:`CoredataError`. Returns a
+        read only memory map of the cached content, or the content as bytes
+        if the client has no cache or the file has no digest.
+        """
+        url = urljoin(self.host, Entity.Files.value + '/')
+        url = urljoin(url, id + '/')
+        url = urljoin(url, Entity.Content.value + '/')
+        url = Utils.add_url_parameters(url, {'sync': str(sync).lower()})
+        if self.blob_cache is not None and digest is None:
+            digest = self._digest(id, sync)
+        if self.blob_cache is None or not digest:
+            return self._request('GET', url).content
+        blob = self.blob_cache.open(digest)
+        if blob is not None:
+            self.stats.incr('blob_cache_hits')
+            return blob
+        self.stats.incr('blob_cache_misses')
+        r = self._request('GET', url, stream=True)
+        try:
+            if not r.ok:
+                raise CoredataError(
+                    'Error occured! Status code is {code} for {url}'.format(
+                        code=r.status_code, url=url))
+            self.blob_cache.put(
+                digest, self._count_received(r.iter_content(1 << 16)))
+        except ValueError as e:
+            # The download does not match the digest.
+            self._forget_digest(id)
+            raise CoredataError('Error! {error} for {url}'.format(
+                error=e, url=url))
+        finally:
+            self._count_received_wire(r)
+            r.close()
+        return self.blob_cache.open(digest)
+
+    def _digest(self, id, sync):
+        """ Return the digest of a file, fetching it if it is not known. """
+        now = clock()
+        known = self._digests.get(id)
+        if known is not None:
+            if now < known[1]:
+                return known[0]
+            self._forget_digest(id)
+        digest = self.get(Entity.Files, id, sync=sync)[
+            'objects'][0].get('digest')
+        if self.digest_ttl:
+            with self._digests_lock:
+                # Drop the digests of files that are not read again at most
+                # once per ttl, rather than on every miss.
+                if now >= self._digests_pruned + self.digest_ttl:
+                    for k in [k for k, v in self._digests.items()
+                              if now >= v[1]]:
+                        del self._digests[k]
+                    self._digests_pruned = now
+                self._digests[id] = (digest, clock() + self.digest_ttl)
+        return digest
+
+    def _forget_digest(self, id):
+        """ Forget the digest of a file that may have changed. """
+        with self._digests_lock:
+            self._digests.pop(id, None)
+
+    def get_page(self, entity, id=None, sub_entity=None, offset=0, limit=20,
+                 search_terms=None, sync=True):
+        """
+        Get a single page of a listing.
+
+        Returns the decoded page, a dict with ``meta`` and ``objects``,
+        without following the link to the next page.
+        """
+        url = urljoin(self.host, entity.value + '/')
+        url = urljoin(url, id + '/') if id else url
+        url = urljoin(url, sub_entity.value + '/') if sub_entity else url
+        terms = {'sync': str(sync).lower(), 'limit': limit, 'offset': offset}
+        if search_terms:
+            terms.update(search_terms)
+        url = Utils.add_url_parameters(url, terms)
+        with self.profiler.page(url):
+            r = self._request('GET', url)
+            if not r.ok:
+                raise CoredataError(
+                    'Error occured! Status code is {code} for {url}'.format(
+                        code=r.status_code, url=url))
+            with self.profiler.phase('decode'):
+                j = r.json()
+                self._intern(j['objects'])
+        return j
+
+    def iter_objects(self, entity, id=None, sub_entity=None, offset=0,
+                     limit=20, search_terms=None, sync=True,
+                     chunk_size=8192, limiter=None):
+        """
+        Iterate over all entities that fufill the given filtering.
+
+        Unlike :meth:`get` every object is yielded as soon as it has been
+        read from the response, so parsing overlaps with the transfer and
+        only a single object is held in memory at a time.
+
+        :param limiter: A :class:`~coredata.throttle.RateLimiter` that is
+            acquired before every page is requested.
+        """
+        url = urljoin(self.host, entity.value + '/')
+        url = urljoin(url, id + '/') if id else url
+        url = urljoin(url, sub_entity.value + '/') if sub_entity else url
+        terms = {'sync': str(sync).lower(), 'limit': limit, 'offset': offset}
+        if search_terms:
+            terms.update(search_terms)
+        profiler = self.profiler
+        with profiler.phase('url'):
+            pages = Pagination(self.host, url, terms)
+            url = pages.first()
+        while url:
+            if limiter is not None:
+                limiter.acquire()
+            with profiler.page(url):
+                r = self._request('GET', url, stream=True)
+                try:
+                    if not r.ok:
+                        raise CoredataError(
+                            'Error occured! Status code is {code} for {url}'
+                            .format(code=r.status_code, url=url))
+                    parser = PageParser(self._count_received(
+                        r.iter_content(chunk_size)))
+                    values = iter(parser)
+                    seen = {}
+                    while True:
+                        # Reading the body is part of decoding a stream.
+                        with profiler.phase('decode'):
+                            obj = next(values, _END)
+                            if obj is _END:
+                                break
+                            if self.interner and obj is not None:
+                                obj = self.interner.intern(obj, seen)
+                        with profiler.phase('callback'):
+                            yield obj
+                finally:
+                    self._count_received_wire(r)
+                    r.close()
+            with profiler.phase('url'):
+                url = pages.next(parser.meta or {})
+
+    def _intern(self, objects):
+        """ Pass the objects through the interner if the client has one. """
+        if self.interner:
+            seen = {}
+            for obj in objects:
+                self.interner.intern(obj, seen)
+        return objects
+
+    def _count_received(self, chunks):
+        """ Count the bytes of a streamed response in the stats. """
+        for chunk in chunks:
+            self.stats.incr('bytes_received', len(chunk))
+            yield chunk
+            self._remaining()
+
+    def _count_received_wire(self, r):
+        """ Count the bytes a streamed response took on the wire. """
+        self.stats.incr(
+            'bytes_received_wire', self.transport.received_bytes(r))
+
+    def get_many(self, entity, ids, concurrency=8, sync=True):
+        """
+        Get many entities by id and return a tuple of (objects, missing).
+
+        The objects are returned in the same order as ``ids`` and ``missing``
+        lists the ids that the server did not return. Ids are fetched with an
+        ``id__in`` filter in chunks that keep the URL below
+        ``MAX_URL_LENGTH``. If the server does not honour the filter the ids
+        are fetched with concurrent single GETs instead.
+        """
+        ids = list(ids)
+        seen = set()
+        unique_ids = [id for id in ids if not (id in seen or seen.add(id))]
+        if not unique_ids:
+            return [], []
+        found = {}
+        pool = ThreadPool(concurrency)
+        try:
+            if self.supports_id_in is not False:
+                chunks = self._chunk_ids(entity, unique_ids, sync)
+                results = pool.map(self._with_deadlines(
+                    lambda chunk: self._get_id_in(entity, chunk, sync)),
+                    chunks)
+                self.supports_id_in = None not in results
+                if self.supports_id_in:
+                    for objects in results:
+                        for obj in objects:
+                            found[obj['id']] = obj
+            if self.supports_id_in is False:
+                objects = pool.map(self._with_deadlines(
+                    lambda id: self._get_single(entity, id, sync)),
+                    unique_ids)
+                for id, obj in zip(unique_ids, objects):
+                    if obj is not None:
+                        found[id] = obj
+        finally:
+            pool.close()
+        objects = [found[id] for id in ids if id in found]
+        missing = [id for id in unique_ids if id not in found]
+        return objects, missing
+
+    def _chunk_ids(self, entity, ids, sync):
+        """ Split ids into chunks that fit into an ``id__in`` URL. """
+        url = urljoin(self.host, entity.value + '/')
+        # Account for the other parameters and a generous limit value.
+        base_length = len(Utils.add_url_parameters(
+            url, {'sync': str(sync).lower(), 'limit': 1000, 'offset': 0,
+                  'id__in': ''}))
+        chunks, chunk, length = [], [], base_length
+        for id in ids:
+            id_length = len(quote(id, safe='')) + len('%2C')
+            if chunk and length + id_length > MAX_URL_LENGTH:
+                chunks.append(chunk)
+                chunk, length = [], base_length
+            chunk.append(id)
+            length += id_length
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _get_id_in(self, entity, ids, sync):
+        """
+        Get a chunk of entities with an ``id__in`` filter.
+
+        The server may cap the page size below the number of ids, so the
+        pages are followed until every match has been read.
+        """
+        pages = Pagination(self.host, urljoin(self.host, entity.value + '/'), {
+            'sync': str(sync).lower(), 'limit': len(ids), 'offset': 0,
+            'id__in': ','.join(ids)})
+        url = pages.first()
+        objects = []
+        while url:
+            r = self._request('GET', url)
+            if r.status_code == 400:
+                # The server refuses to filter on id__in.
+                return None
+            elif not r.ok:
+                raise CoredataError(
+                    'Error occured! Status code is {code} for {url}'.format(
+                        code=r.status_code, url=url))
+            j = r.json()
+            total_count = j['meta']['total_count']
+            if total_count > len(ids):
+                # The filter was ignored and we got the whole listing.
+                return None
+            objects.extend(j['objects'])
+            url = pages.next(j['meta']) if j['objects'] else None
+        if len(objects) < total_count:
+            # The server cut the matches short without linking to the rest.
+            return None
+        return objects
+
+    def count(self, entity, search_terms=None, sync=True):
+        """
+        Return the number of entities that match ``search_terms``.
+
+        Reads the ``total_count`` of a single object page instead of getting
+        the whole listing. Counts are cached for ``count_ttl`` seconds.
+        """
+        key = json.dumps([entity.value, sync, search_terms or {}],
+                         sort_keys=True, default=str)
+        now = clock()
+        cached = self._counts.get(key)
+        if cached is not None:
+            if now < cached[1]:
+                self.stats.incr('count_cache_hits')
+                return cached[0]
+            with self._counts_lock:
+                self._counts.pop(key, None)
+        j = self.get_page(entity, limit=1, search_terms=search_terms,
+                          sync=sync)
+        count = j['meta']['total_count']
+        if self.count_ttl:
+            with self._counts_lock:
+                # Drop the counts of filters that are not asked for again
+                # at most once per ttl, rather than on every miss.
+                if now >= self._counts_pruned + self.count_ttl:
+                    for k in [k for k, v in self._counts.items()
+                              if now >= v[1]]:
+                        del self._counts[k]
+                    self._counts_pruned = now
+                self._counts[key] = (count, clock() + self.count_ttl)
+        return count
+
+    def aggregate(self, entity, filters, search_terms=None, concurrency=8,
+                  sync=True):
+        """
+        Count the entities that match each of many filters concurrently.
+
+        ``filters`` maps names to search terms, which are added to
+        ``search_terms``, and the counts are returned by the same names::
+
+            client.aggregate(Entity.Files, {
+                'drafts': {'status': 'draft'},
+                'approved': {'status': 'approved'}},
+                search_terms={'space': space_id})
+        """
+        names = list(filters)
+        terms = []
+        for name in names:
+            combined = dict(search_terms or {})
+            combined.update(filters[name])
+            terms.append(combined)
+        pool = ThreadPool(concurrency)
+        try:
+            counts = pool.map(self._with_deadlines(
+                lambda t: self.count(entity, search_terms=t, sync=sync)),
+                terms)
+        finally:
+            pool.close()
+        return dict(zip(names, counts))
+
+    def facets(self, entity, field, values, search_terms=None,
+               concurrency=8, sync=True):
+        """
+        Count the entities for each value of ``field``.
+
+        Returns a dict from each of ``values`` to the number of entities
+        that also match ``search_terms``.
+        """
+        return self.aggregate(
+            entity, dict((value, {field: value}) for value in values),
+            search_terms=search_terms, concurrency=concurrency, sync=sync)
+
+    def _get_single(self, entity, id, sync):
+        """ Get a single entity or None if it does not exist. """
+        url = urljoin(self.host, entity.value + '/')
+        url = urljoin(url, id + '/')
+        url = Utils.add_url_parameters(url, {'sync': str(sync).lower()})
+        r = self._request('GET', url)
+        if r.status_code == 404:
+            return None
+        elif r.ok:
+            return r.json()
         else:
             raise CoredataError(
                 'Error occured! Status code is {code} for {url}'.format(
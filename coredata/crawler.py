@@ -0,0 +1,131 @@
+""" Crawl large Coredata listings with a pool of processes. """
+
+import json
+import multiprocessing
+import os
+
+from .coredata import CoredataClient
+
+# The client of the current worker process, created by _init_worker.
+_worker = {}
+
+
+def _init_worker(host, auth, client_options, transform):
+    """ Give each worker process its own client and session. """
+    _worker['client'] = CoredataClient(host, auth, **client_options)
+    _worker['transform'] = transform
+
+
+def _fetch_range(task):
+    """ Fetch the objects in an offset range and return them transformed. """
+    entity, search_terms, start, stop, page_size = task
+    client, transform = _worker['client'], _worker['transform']
+    batch = []
+    for offset in range(start, stop, page_size):
+        limit = min(page_size, stop - offset)
+        page = client.get_page(
+            entity, offset=offset, limit=limit, search_terms=search_terms)
+        objects = page['objects']
+        if transform:
+            batch.extend(transform(obj) for obj in objects)
+        else:
+            batch.extend(objects)
+        if len(objects) < limit:
+            break
+    return batch
+
+
+def _write_range(task):
+    """ Fetch the objects in an offset range and write them to a shard. """
+    path, task = task[0], task[1:]
+    batch = _fetch_range(task)
+    with open(path, 'w') as f:
+        for obj in batch:
+            f.write(json.dumps(obj, separators=(',', ':')) + '\n')
+    return path, len(batch)
+
+
+class Crawler(object):
+
+    """
+    Crawl a listing with a pool of processes that decode the pages.
+
+    The listing is split into offset ranges, optionally per partition such as
+    a space or a project, and every worker process fetches its ranges with
+    its own :class:`~coredata.CoredataClient`. Decoding and the optional
+    ``transform`` then run in parallel instead of on a single core.
+
+    ``transform`` is called with every object in the worker process and must
+    be picklable, e.g. a module level function. ``client_options`` are passed
+    to the client in each worker.
+    """
+
+    def __init__(self, host, auth, processes=None, page_size=100,
+                 pages_per_batch=10, transform=None, client_options=None):
+        """ Initialize the crawler. """
+        self.host = host
+        self.auth = auth
+        self.processes = processes or multiprocessing.cpu_count()
+        self.page_size = page_size
+        self.pages_per_batch = pages_per_batch
+        self.transform = transform
+        self.client_options = client_options or {}
+
+    def tasks(self, entity, search_terms=None, partitions=None):
+        """
+        Split a listing into offset ranges for the workers.
+
+        :param partitions: A list of search terms, e.g. one
+            ``{'space': id}`` per space, that are crawled separately.
+        """
+        client = CoredataClient(self.host, self.auth, **self.client_options)
+        batch_size = self.page_size * self.pages_per_batch
+        tasks = []
+        for partition in partitions or [{}]:
+            terms = dict(search_terms or {}, **partition)
+            page = client.get_page(entity, limit=1, search_terms=terms)
+            total = page['meta']['total_count']
+            for start in range(0, total, batch_size):
+                stop = min(start + batch_size, total)
+                tasks.append((entity, terms, start, stop, self.page_size))
+        client.transport.close()
+        return tasks
+
+    def _pool(self):
+        """ Create the worker pool. """
+        return multiprocessing.Pool(
+            self.processes, _init_worker,
+            (self.host, self.auth, self.client_options, self.transform))
+
+    def crawl(self, entity, search_terms=None, partitions=None,
+              ordered=False):
+        """
+        Crawl a listing and yield batches of objects as workers finish them.
+
+        Batches arrive in the order they finish unless ``ordered`` is True.
+        """
+        tasks = self.tasks(entity, search_terms, partitions)
+        pool = self._pool()
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for batch in imap(_fetch_range, tasks):
+                yield batch
+        finally:
+            pool.terminate()
+
+    def crawl_to_files(self, entity, directory, search_terms=None,
+                       partitions=None):
+        """
+        Crawl a listing into sharded NDJSON files in ``directory``.
+
+        The workers write the shards themselves so the objects never pass
+        through the parent process. Returns a list of (path, count) tuples.
+        """
+        tasks = self.tasks(entity, search_terms, partitions)
+        tasks = [(os.path.join(directory, 'part-{0:05d}.ndjson'.format(i)),)
+                 + task for i, task in enumerate(tasks)]
+        pool = self._pool()
+        try:
+            return pool.map(_write_range, tasks)
+        finally:
+            pool.terminate()
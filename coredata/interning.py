@@ -0,0 +1,130 @@
+""" Share repeated values between the objects of large listings. """
+
+import sys
+
+string_types = (str, type(u''))
+
+
+class FrozenDict(dict):
+
+    """ A read only dict that can be shared between many objects. """
+
+    def _read_only(self, *args, **kwargs):
+        """ Refuse to change the dict. """
+        raise TypeError('Shared objects are read only.')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        """ Return the dict itself, it can not change. """
+        return self
+
+    def __deepcopy__(self, memo):
+        """ Return the dict itself, it can not change. """
+        return self
+
+    def __reduce__(self):
+        """ Pickle the dict without going through ``__setitem__``. """
+        return FrozenDict, (dict(self),)
+
+
+class Interner(object):
+
+    """
+    Share repeated strings and nested objects between decoded objects.
+
+    Listings repeat the same values on every object, e.g. ``created_by``,
+    ``category`` and the ``dynatype`` of a file. The interner keeps a single
+    instance of every string and of every structurally identical nested dict
+    or list and replaces the copies with it, so a large in-memory catalogue
+    only holds each distinct value once. Use the same interner for a whole
+    crawl to share values between pages.
+
+    The top level objects stay ordinary dicts, but nested dicts become read
+    only :class:`FrozenDict` instances and nested lists become tuples since
+    they are shared. ``bytes_saved`` estimates the memory that was saved.
+    """
+
+    def __init__(self):
+        """ Initialize an empty interner. """
+        self._strings = {}
+        self._values = {}
+        # The bytes of the replaced copies and of the keys of ``_values``.
+        self._replaced = 0
+        self._keys = 0
+
+    @property
+    def bytes_saved(self):
+        """ The bytes of the replaced copies less those of the tables. """
+        return (self._replaced - self._keys - sys.getsizeof(self._strings) -
+                sys.getsizeof(self._values))
+
+    def intern(self, obj, seen=None):
+        """
+        Intern the values of a decoded object in place and return it.
+
+        Objects of the same page should share ``seen``, a dict, so a copy
+        that several of them refer to, like the keys ``json.loads`` shares,
+        is only counted as replaced once.
+        """
+        if seen is None:
+            seen = {}
+        items = [(self._string(key, seen), self._intern(value, seen)[0])
+                 for key, value in obj.items()]
+        # Insert the items again so the dict uses the shared keys.
+        obj.clear()
+        obj.update(items)
+        return obj
+
+    def _replace(self, value, seen):
+        """ Count a copy that is replaced by the shared instance. """
+        if id(value) not in seen:
+            # Keep the copy so its id is not reused while counting.
+            seen[id(value)] = value
+            self._replaced += sys.getsizeof(value)
+
+    def _string(self, value, seen):
+        """ Return the shared instance of a string. """
+        shared = self._strings.setdefault(value, value)
+        if shared is not value:
+            self._replace(value, seen)
+        return shared
+
+    def _intern(self, value, seen):
+        """ Return the shared instance of a value and its structural key. """
+        if isinstance(value, string_types):
+            value = self._string(value, seen)
+            return value, value
+        elif isinstance(value, dict):
+            items = [(self._string(key, seen), self._intern(item, seen))
+                     for key, item in value.items()]
+            pairs = tuple(sorted(
+                (name, item_key) for name, (_, item_key) in items))
+            key = ('dict', pairs)
+            # Strings and nested values have been counted as they were
+            # interned so a duplicate only saves the size of the dict itself.
+            shared = self._values.get(key)
+            if shared is None:
+                shared = FrozenDict(
+                    (name, item) for name, (item, _) in items)
+                self._values[key] = shared
+                self._keys += sys.getsizeof(key) + sys.getsizeof(pairs) + \
+                    sum(sys.getsizeof(pair) for pair in pairs)
+            else:
+                self._replace(value, seen)
+            return shared, key
+        elif isinstance(value, (list, tuple)):
+            items = [self._intern(item, seen) for item in value]
+            item_keys = tuple(item_key for _, item_key in items)
+            key = ('list', item_keys)
+            shared = self._values.get(key)
+            if shared is None:
+                shared = tuple(item for item, _ in items)
+                self._values[key] = shared
+                self._keys += sys.getsizeof(key) + sys.getsizeof(item_keys)
+            else:
+                self._replace(value, seen)
+            return shared, key
+        # Numbers, booleans and None. The type keeps 1, 1.0 and True apart.
+        return value, (type(value).__name__, value)
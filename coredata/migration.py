@@ -0,0 +1,206 @@
+""" Create many entities that reference each other, in dependency order. """
+
+import json
+import os
+
+from multiprocessing.pool import ThreadPool
+from .coredata import CoredataError
+try:
+    # Python3
+    from queue import Queue
+except ImportError:
+    # Python2
+    from Queue import Queue
+
+
+class MigrationError(CoredataError):
+
+    """ Raised when some entities of a migration could not be created. """
+
+    def __init__(self, errors, blocked):
+        """ Keep the errors by key and the keys that were not attempted. """
+        super(MigrationError, self).__init__(
+            '{failed} entities failed and {blocked} were blocked: {errors}'
+            .format(failed=len(errors), blocked=len(blocked), errors=errors))
+        self.errors = errors
+        self.blocked = blocked
+
+
+class Ref(object):
+
+    """ Stands in for the id of another entity of the migration. """
+
+    def __init__(self, key):
+        """ Refer to the entity added with ``key``. """
+        self.key = key
+
+    def __repr__(self):
+        """ Show the key that is referred to. """
+        return 'Ref({key!r})'.format(key=self.key)
+
+
+def find_refs(value):
+    """ Return the keys of all the references in a payload. """
+    if isinstance(value, Ref):
+        return set([value.key])
+    elif isinstance(value, dict):
+        values = value.values()
+    elif isinstance(value, (list, tuple)):
+        values = value
+    else:
+        return set()
+    return set().union(*[find_refs(item) for item in values])
+
+
+def resolve_refs(value, ids):
+    """ Return a copy of a payload with the references replaced by ids. """
+    if isinstance(value, Ref):
+        return ids[value.key]
+    elif isinstance(value, dict):
+        return dict((k, resolve_refs(v, ids)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [resolve_refs(item, ids) for item in value]
+    return value
+
+
+class Migration(object):
+
+    """
+    Create entities that reference each other concurrently.
+
+    Every entity is added with a key, and payloads refer to the ids of other
+    entities with :class:`Ref`::
+
+        migration = Migration(client, checkpoint='migration.json')
+        migration.add('space', Entity.Spaces, {'title': 'Finance'})
+        migration.add('project', Entity.Projects,
+                      {'space': Ref('space'), 'title': '2014-35'})
+        migration.add('file', Entity.Files, {'parent': Ref('project')})
+        ids = migration.run(concurrency=8)
+
+    An entity is created as soon as the entities it refers to have been, so
+    independent branches are created concurrently. The ids of the created
+    entities are appended to the ``checkpoint`` file as they come in and a
+    migration that is run again with the same checkpoint skips them.
+    """
+
+    def __init__(self, client, checkpoint=None):
+        """ Initialize an empty migration. """
+        self.client = client
+        self.checkpoint = checkpoint
+        self.entities = {}
+        self.dependencies = {}
+
+    def add(self, key, entity, payload, depends_on=()):
+        """
+        Add an entity to create.
+
+        :param depends_on: Keys of entities that must be created first even
+            though the payload does not refer to them.
+        """
+        if key in self.entities:
+            raise ValueError('Duplicate key: {key}'.format(key=key))
+        self.entities[key] = (entity, payload)
+        self.dependencies[key] = find_refs(payload) | set(depends_on)
+
+    def order(self):
+        """ Return the keys in an order that respects the dependencies. """
+        for key, dependencies in self.dependencies.items():
+            unknown = dependencies - set(self.entities)
+            if unknown:
+                raise ValueError('{key} refers to unknown keys: {unknown}'
+                                 .format(key=key, unknown=sorted(unknown)))
+        order, done = [], set()
+        remaining = dict(self.dependencies)
+        while remaining:
+            ready = sorted(key for key, dependencies in remaining.items()
+                           if dependencies <= done)
+            if not ready:
+                raise ValueError('Circular references between: {keys}'
+                                 .format(keys=sorted(remaining)))
+            for key in ready:
+                del remaining[key]
+            done.update(ready)
+            order.extend(ready)
+        return order
+
+    def load_checkpoint(self):
+        """ Return the ids that a previous run created. """
+        ids = {}
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return ids
+        with open(self.checkpoint) as f:
+            for line in f:
+                try:
+                    key, id = json.loads(line)
+                except ValueError:
+                    # The last line is cut short if a run was killed.
+                    continue
+                ids[key] = id
+        return ids
+
+    def _create(self, key, ids):
+        """ Create an entity and return the key with the id or error. """
+        entity, payload = self.entities[key]
+        try:
+            id = self.client.create(entity, resolve_refs(payload, ids))
+        except Exception as e:
+            return key, None, e
+        return key, id, None
+
+    def run(self, concurrency=8):
+        """
+        Create the entities and return their ids by key.
+
+        Raises :class:`MigrationError` when some entities fail. The entities
+        that depended on them are not attempted.
+        """
+        order = self.order()
+        ids = dict((key, id) for key, id in self.load_checkpoint().items()
+                   if key in self.entities)
+        dependents = dict((key, []) for key in order)
+        for key in order:
+            for dependency in self.dependencies[key]:
+                dependents[dependency].append(key)
+        checkpoint = open(self.checkpoint, 'a') if self.checkpoint else None
+        results = Queue()
+        pool = ThreadPool(concurrency)
+        submitted, errors = set(ids), {}
+
+        def ready(key):
+            return key not in submitted and all(
+                dependency in ids for dependency in self.dependencies[key])
+
+        def submit(key):
+            submitted.add(key)
+            refs = dict((dependency, ids[dependency])
+                        for dependency in self.dependencies[key])
+            pool.apply_async(self._create, (key, refs), callback=results.put)
+
+        try:
+            for key in order:
+                if ready(key):
+                    submit(key)
+            in_flight = len(submitted) - len(ids)
+            while in_flight:
+                key, id, error = results.get()
+                in_flight -= 1
+                if error is not None:
+                    errors[key] = error
+                    continue
+                ids[key] = id
+                if checkpoint:
+                    checkpoint.write(json.dumps([key, id]) + '\n')
+                    checkpoint.flush()
+                for dependent in dependents[key]:
+                    if ready(dependent):
+                        submit(dependent)
+                        in_flight += 1
+        finally:
+            pool.terminate()
+            if checkpoint:
+                checkpoint.close()
+        if errors:
+            blocked = [key for key in order if key not in submitted]
+            raise MigrationError(errors, blocked)
+        return ids
@@ -0,0 +1,210 @@
+""" Where the time and memory of a client's requests go. """
+
+import heapq
+import threading
+import time
+
+from contextlib import contextmanager
+from .throttle import clock
+try:
+    import tracemalloc
+except ImportError:
+    # Python2
+    tracemalloc = None
+
+try:
+    # Python3.7
+    cpu_clock = time.thread_time
+except AttributeError:
+    cpu_clock = getattr(time, 'process_time', time.clock)
+
+
+class NullPhase(object):
+
+    """ A context that measures nothing. """
+
+    def __enter__(self):
+        """ Do nothing. """
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Do nothing. """
+        return False
+
+
+class NullProfile(object):
+
+    """ Stands in for a :class:`Profile` while a client is not profiling. """
+
+    _phase = NullPhase()
+
+    def phase(self, name, url=None):
+        """ Return a context that measures nothing. """
+        return self._phase
+
+    def page(self, url):
+        """ Return a context that measures nothing. """
+        return self._phase
+
+
+class Phase(object):
+
+    """ Measures the wall and CPU time of a phase for a :class:`Profile`. """
+
+    def __init__(self, profile, name, url):
+        """ Initialize the measurement. """
+        self.profile = profile
+        self.name = name
+        self.url = url
+
+    def __enter__(self):
+        """ Start the clocks. """
+        self.started = clock()
+        self.cpu_started = cpu_clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Stop the clocks and record the times. """
+        self.profile.record(self.name, clock() - self.started,
+                            cpu_clock() - self.cpu_started, self.url)
+        return False
+
+
+class Profile(object):
+
+    """
+    Wall and CPU time by phase, the slowest requests and memory by page.
+
+    A client records four phases while it is profiled: ``url`` for building
+    and following pagination links, ``network`` for requests, ``decode`` for
+    parsing and interning responses and ``callback`` for the time the code
+    that iterates over :meth:`~coredata.CoredataClient.iter_objects` spends
+    with every object::
+
+        with client.profile(trace_memory=True) as profile:
+            client.get(Entity.Files)
+        print(profile.summary())
+
+    The CPU time is that of the thread where the phase ran, if the platform
+    can tell. With ``trace_memory`` the peak memory and the lines that
+    allocated the most are recorded for every page. :mod:`tracemalloc` traces
+    the whole process, so those are only accurate when pages are fetched one
+    at a time.
+    """
+
+    def __init__(self, trace_memory=False, slowest=10, allocations=3):
+        """ Initialize an empty profile. """
+        if trace_memory and tracemalloc is None:
+            raise ImportError('Tracing memory requires tracemalloc.')
+        self.trace_memory = trace_memory
+        self.slowest = slowest
+        self.allocations = allocations
+        # The calls, wall time and CPU time by phase.
+        self.phases = {}
+        self.pages = []
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._started_tracing = False
+
+    def start(self):
+        """ Start tracing memory if asked to. """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """ Stop tracing memory if :meth:`start` started it. """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def phase(self, name, url=None):
+        """ Return a context that measures a phase. """
+        return Phase(self, name, url)
+
+    def record(self, name, wall, cpu, url=None):
+        """ Add the times of a phase, and of a request to ``url``. """
+        with self._lock:
+            totals = self.phases.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            if url is not None and self.slowest:
+                entry = (wall, url, name)
+                if len(self._slowest) < self.slowest:
+                    heapq.heappush(self._slowest, entry)
+                else:
+                    heapq.heappushpop(self._slowest, entry)
+
+    @contextmanager
+    def page(self, url):
+        """ Measure the time and memory it takes to get a page. """
+        page = {'url': url}
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            before = tracemalloc.take_snapshot()
+            current = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        started = clock()
+        try:
+            yield page
+        finally:
+            page['wall'] = clock() - started
+            if tracing:
+                page['peak_memory'] = \
+                    tracemalloc.get_traced_memory()[1] - current
+                differences = tracemalloc.take_snapshot().compare_to(
+                    before, 'lineno')
+                page['allocations'] = [
+                    (str(difference.traceback), difference.size_diff)
+                    for difference in differences[:self.allocations]
+                    if difference.size_diff > 0]
+            with self._lock:
+                self.pages.append(page)
+
+    def report(self):
+        """
+        Return the profile as a dict.
+
+        ``phases`` lists the phases with the most wall time first,
+        ``slowest`` the slowest requests and ``pages`` every page.
+        """
+        with self._lock:
+            phases = sorted(self.phases.items(),
+                            key=lambda item: item[1][1], reverse=True)
+            slowest = sorted(self._slowest, reverse=True)
+            pages = list(self.pages)
+        peaks = [page['peak_memory'] for page in pages
+                 if 'peak_memory' in page]
+        return {
+            'phases': [{'name': name, 'calls': calls, 'wall': wall,
+                        'cpu': cpu} for name, (calls, wall, cpu) in phases],
+            'slowest': [{'url': url, 'phase': name, 'wall': wall}
+                        for wall, url, name in slowest],
+            'pages': pages,
+            'peak_memory': max(peaks) if peaks else None,
+        }
+
+    def summary(self):
+        """ Return the report as text. """
+        report = self.report()
+        lines = ['{0:<10} {1:>8} {2:>10} {3:>10}'.format(
+            'phase', 'calls', 'wall', 'cpu')]
+        for phase in report['phases']:
+            lines.append('{name:<10} {calls:>8} {wall:>10.3f} {cpu:>10.3f}'
+                         .format(**phase))
+        if report['slowest']:
+            lines.append('')
+            lines.append('slowest requests:')
+            for request in report['slowest']:
+                lines.append('{wall:>10.3f} {url}'.format(**request))
+        if report['pages']:
+            lines.append('')
+            lines.append('{0} pages, slowest {1:.3f}s'.format(
+                len(report['pages']),
+                max(page['wall'] for page in report['pages'])))
+        if report['peak_memory'] is not None:
+            lines.append('peak memory of a page: {0} bytes'.format(
+                report['peak_memory']))
+        return '\n'.join(lines)
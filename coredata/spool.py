@@ -0,0 +1,147 @@
+""" Listings kept on disk rather than in memory. """
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from array import array
+
+# Every record is its length followed by the object as compact JSON.
+HEADER = struct.Struct('>I')
+
+try:
+    array('Q')
+    OFFSET = 'Q'
+except ValueError:
+    # Python 2 has no 64 bit arrays, doubles hold offsets up to 2 ** 53.
+    OFFSET = 'd'
+
+
+class SpooledListing(object):
+
+    """
+    A read only sequence of objects that are kept in a file.
+
+    Objects are appended as length prefixed JSON records and only the
+    offsets of the records, and an index from ``id`` to position, are kept
+    in memory. ``len()``, indexing, slicing and iteration read the records
+    from a memory map of the file as they are needed::
+
+        files = client.get(Entity.Files, spool=True)
+        files[10000]['title']
+        files.get_by_id('4ab3bb32-3e72-11e4-bfaa-ebeae41148db')
+
+    The file is a temporary file unless a ``path`` is given. On POSIX it is
+    unlinked as soon as it is created so that nothing is left behind, and
+    elsewhere it is removed on :meth:`close` or when the listing is garbage
+    collected.
+    """
+
+    def __init__(self, path=None):
+        """ Create an empty spool file. """
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.spool')
+            self.file = os.fdopen(fd, 'w+b')
+            self.temporary = True
+            if os.name == 'posix':
+                # The open file lives on until it is closed.
+                os.remove(path)
+        else:
+            self.file = open(path, 'w+b')
+            self.temporary = False
+        self.path = path
+        self._offsets = array(OFFSET)
+        self._ids = {}
+        self._size = 0
+        self._map = None
+        self._lock = threading.Lock()
+
+    def append(self, obj):
+        """ Write an object to the end of the file. """
+        data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            self.file.seek(self._size)
+            self.file.write(HEADER.pack(len(data)) + data)
+            if isinstance(obj, dict) and 'id' in obj:
+                self._ids[obj['id']] = len(self._offsets)
+            self._offsets.append(self._size)
+            self._size += HEADER.size + len(data)
+
+    def extend(self, objects):
+        """ Write objects to the end of the file. """
+        for obj in objects:
+            self.append(obj)
+
+    def __len__(self):
+        """ Return the number of objects. """
+        return len(self._offsets)
+
+    def _read(self, index):
+        """ Read the object at a non-negative index. """
+        with self._lock:
+            if self._map is None or len(self._map) < self._size:
+                # Map the file again to see the records written since.
+                self.file.flush()
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(
+                    self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            start = int(self._offsets[index])
+            length, = HEADER.unpack_from(self._map, start)
+            start += HEADER.size
+            data = self._map[start:start + length]
+        return json.loads(data.decode('utf-8'))
+
+    def __getitem__(self, index):
+        """ Return the object at ``index`` or a list for a slice. """
+        if isinstance(index, slice):
+            return [self._read(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('SpooledListing index out of range')
+        return self._read(index)
+
+    def __iter__(self):
+        """ Iterate over the objects in order. """
+        for index in range(len(self)):
+            yield self._read(index)
+
+    def index(self, id):
+        """ Return the position of the object with ``id``. """
+        try:
+            return self._ids[id]
+        except KeyError:
+            raise ValueError('{id} is not in the listing'.format(id=id))
+
+    def get_by_id(self, id, default=None):
+        """ Return the object with ``id`` or ``default``. """
+        index = self._ids.get(id)
+        return default if index is None else self._read(index)
+
+    def close(self):
+        """ Close the file, and remove it if it is temporary. """
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self.file.close()
+            if self.temporary and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __del__(self):
+        """ Close the listing if it was never closed. """
+        file = getattr(self, 'file', None)
+        if file is not None and not file.closed:
+            self.close()
+
+    def __enter__(self):
+        """ Use the listing as a context manager that closes it. """
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Close the listing. """
+        self.close()
@@ -0,0 +1,87 @@
+""" Counters that a client keeps about the requests it makes. """
+
+import threading
+
+from collections import defaultdict, deque
+
+
+class ClientStats(object):
+
+    """
+    Thread safe counters for a client.
+
+    Counters are created on first use and read with ``stats['name']``, which
+    returns 0 for counters that have never been incremented.
+    """
+
+    def __init__(self):
+        """ Initialize empty counters. """
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def incr(self, name, value=1):
+        """ Increment the counter ``name`` by ``value``. """
+        with self._lock:
+            self._counters[name] += value
+
+    def __getitem__(self, name):
+        """ Return the value of the counter ``name``. """
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def as_dict(self):
+        """ Return a copy of all the counters. """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        """ Set all the counters back to zero. """
+        with self._lock:
+            self._counters.clear()
+
+    def _ratio(self, raw, wire):
+        """ Return the ratio between two counters or None if unknown. """
+        with self._lock:
+            raw, wire = self._counters.get(raw), self._counters.get(wire)
+        return float(raw) / wire if raw and wire else None
+
+    @property
+    def received_compression_ratio(self):
+        """ Decoded bytes received per byte transferred. """
+        return self._ratio('bytes_received', 'bytes_received_wire')
+
+    @property
+    def sent_compression_ratio(self):
+        """ Payload bytes sent per byte transferred. """
+        return self._ratio('bytes_sent', 'bytes_sent_wire')
+
+
+class LatencyTracker(object):
+
+    """
+    Keep the latencies of recent requests to pick a hedging delay.
+
+    :meth:`threshold` returns the ``percentile`` of the last ``size``
+    latencies, or None until ``min_samples`` have been seen.
+    """
+
+    def __init__(self, percentile=95, size=200, min_samples=20):
+        """ Initialize an empty tracker. """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=size)
+
+    def add(self, seconds):
+        """ Record the latency of a request. """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def threshold(self):
+        """ Return the latency a request should be hedged after. """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
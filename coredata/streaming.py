@@ -0,0 +1,168 @@
+""" Incremental parsing of Coredata listing pages. """
+
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# The characters that open or close a value, and those that end a string.
+STRUCTURE = re.compile(r'["\[\]{}]')
+STRING_END = re.compile(r'["\\]')
+
+
+class PageParser(object):
+
+    """
+    Parse a listing page as its body arrives.
+
+    The parser reads chunks of the body, for example from
+    ``response.iter_content()``, and yields every item of the ``objects``
+    array as soon as it is complete. Other top level values, like ``meta``,
+    are decoded as a whole and stored on the parser::
+
+        parser = PageParser(response.iter_content(8192))
+        for obj in parser:
+            ...
+        next_path = parser.meta['next']
+
+    ``meta`` is available once the parser has passed it in the body and all
+    top level values except ``objects`` are kept in ``values``.
+    """
+
+    def __init__(self, chunks):
+        """ Initialize the parser with an iterable of byte chunks. """
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+        self.values = {}
+
+    @property
+    def meta(self):
+        """ The ``meta`` object of the page if it has been parsed. """
+        return self.values.get('meta')
+
+    def _read(self):
+        """ Read another chunk into the buffer, return False at the end. """
+        if self.exhausted:
+            return False
+        # Drop what has been parsed so the buffer only holds a single value.
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        for chunk in self.chunks:
+            text = self.text_decoder.decode(chunk)
+            if text:
+                self.buffer += text
+                return True
+        self.exhausted = True
+        self.buffer += self.text_decoder.decode(b'', final=True)
+        return False
+
+    def _skip_whitespace(self):
+        """ Move past whitespace, reading more if the buffer runs out. """
+        while True:
+            self.position = WHITESPACE.match(
+                self.buffer, self.position).end()
+            if self.position < len(self.buffer) or not self._read():
+                return
+
+    def _peek(self):
+        """ Return the next significant character or '' at the end. """
+        self._skip_whitespace()
+        return self.buffer[self.position:self.position + 1]
+
+    def _expect(self, characters):
+        """ Consume one of ``characters`` and return it. """
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError('Expected {expected!r} at {position}'.format(
+                expected=characters, position=self.position))
+        self.position += 1
+        return character
+
+    def _complete(self):
+        """
+        Read until the object, array or string at the position has ended.
+
+        The scan carries on from where the last chunk ended, so a value is
+        only read once however many chunks it spans.
+        """
+        index = self.position
+        depth = 0
+        in_string = False
+        while True:
+            buffer = self.buffer
+            while index < len(buffer):
+                if in_string:
+                    match = STRING_END.search(buffer, index)
+                    if match is None:
+                        index = len(buffer)
+                        break
+                    index = match.end()
+                    if match.group() == '\\':
+                        # Skip the escaped character, maybe in a later chunk.
+                        index += 1
+                        continue
+                    in_string = False
+                else:
+                    match = STRUCTURE.search(buffer, index)
+                    if match is None:
+                        index = len(buffer)
+                        break
+                    index = match.end()
+                    character = match.group()
+                    if character == '"':
+                        in_string = True
+                        continue
+                    depth += 1 if character in '[{' else -1
+                if depth <= 0:
+                    return
+            scanned = index - self.position
+            if not self._read():
+                return
+            index = self.position + scanned
+
+    def _value(self):
+        """ Decode the next complete JSON value. """
+        scalar = self._peek() not in ('{', '[', '"')
+        if not scalar:
+            self._complete()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(
+                    self.buffer, self.position)
+            except ValueError:
+                # The value is incomplete, unless the body has ended.
+                if not self._read():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next
+            # chunk.
+            if scalar and end == len(self.buffer) and self._read():
+                continue
+            self.position = end
+            return value
+
+    def __iter__(self):
+        """ Yield the items of the ``objects`` array as they are parsed. """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'objects' and self._peek() == '[':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.values[key] = self._value()
+            if self._expect(',}') == '}':
+                return
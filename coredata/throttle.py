@@ -0,0 +1,43 @@
+""" Rate limiting for clients that make many requests. """
+
+import threading
+import time
+
+# Python 2 has no monotonic clock.
+clock = getattr(time, 'monotonic', time.time)
+
+
+class RateLimiter(object):
+
+    """
+    A thread safe token bucket that limits how often something happens.
+
+    :meth:`acquire` blocks until the next event is allowed. ``rate`` is the
+    number of events per second and ``burst`` how many may happen at once
+    after a quiet period. A rate of None or 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        """ Initialize a full bucket. """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until an event is allowed and take a token for it. """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = clock()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,372 @@
+""" Pluggable HTTP transports for the Coredata client. """
+
+import json
+import os
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import HTTPResponse
+try:
+    # Python3
+    from http.cookiejar import DefaultCookiePolicy
+    from urllib.parse import urlsplit
+except ImportError:
+    # Python2
+    from cookielib import DefaultCookiePolicy
+    from urlparse import urlsplit
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class TransportTimeout(Exception):
+
+    """ Raised by transports when a request times out. """
+
+    pass
+
+
+class Transport(object):
+
+    """
+    The interface the client uses to talk HTTP.
+
+    A transport sends a request and returns a response that behaves like a
+    :class:`requests.Response`, that is, it has ``status_code``, ``ok``,
+    ``headers``, ``content``, ``json()``, ``iter_content()`` and ``close()``.
+
+    A request that takes longer than ``timeout`` seconds to connect or to
+    receive data raises :class:`TransportTimeout`.
+    """
+
+    def request(self, method, url, auth=None, headers=None, data=None,
+                stream=False, timeout=None):
+        """ Send a request and return the response. """
+        raise NotImplementedError
+
+    def received_bytes(self, response):
+        """ Return the number of body bytes that came over the wire. """
+        length = response.headers.get('content-length')
+        return int(length) if length else len(response.content)
+
+    def decoded_encodings(self, url):
+        """ Return the content encodings of responses that are decoded. """
+        return ['gzip']
+
+    def close(self):
+        """ Release the connections held by the transport. """
+        pass
+
+
+class RequestsTransport(Transport):
+
+    """
+    A HTTP/1.1 transport that keeps connections in a requests session.
+
+    :param pool_maxsize: The number of connections kept per host.
+    :param pool_block: Wait for a free connection rather than open more
+        than ``pool_maxsize`` connections to a host.
+    :param store_cookies: Keep cookies set by the server in the session.
+        Transports shared between clients with different credentials must
+        not, or one client would send the cookies of another.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 store_cookies=True):
+        """ Initialize the session and its connection pool. """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not store_cookies:
+            self.session.cookies.set_policy(
+                DefaultCookiePolicy(allowed_domains=[]))
+
+    def request(self, method, url, auth=None, headers=None, data=None,
+                stream=False, timeout=None):
+        """ Send a request through the session. """
+        try:
+            return self.session.request(
+                method, url, auth=auth, headers=headers, data=data,
+                stream=stream, timeout=timeout)
+        except requests.Timeout as e:
+            raise TransportTimeout(e)
+
+    def received_bytes(self, response):
+        """ Return the number of body bytes that came over the wire. """
+        try:
+            return response.raw.tell()
+        except AttributeError:
+            return super(RequestsTransport, self).received_bytes(response)
+
+    def decoded_encodings(self, url):
+        """ Return the content encodings that urllib3 decodes. """
+        return list(getattr(HTTPResponse, 'CONTENT_DECODERS', ['gzip']))
+
+    def close(self):
+        """ Close the session and its pooled connections. """
+        self.session.close()
+
+
+class HTTP2Response(object):
+
+    """ Make a httpx response look like a requests response. """
+
+    def __init__(self, response):
+        """ Wrap the httpx response. """
+        self.response = response
+
+    @property
+    def status_code(self):
+        """ The HTTP status code of the response. """
+        return self.response.status_code
+
+    @property
+    def ok(self):
+        """ True if the status code is less than 400. """
+        return self.response.status_code < 400
+
+    @property
+    def headers(self):
+        """ The response headers. """
+        return self.response.headers
+
+    @property
+    def content(self):
+        """ The whole response body as bytes. """
+        return self.response.read()
+
+    def json(self):
+        """ Decode the response body as JSON. """
+        return self.response.json()
+
+    def iter_content(self, chunk_size=1):
+        """ Iterate over the decoded response body. """
+        return self.response.iter_bytes(chunk_size)
+
+    def close(self):
+        """ Release the connection back to the pool. """
+        self.response.close()
+
+
+class BufferedResponse(object):
+
+    """
+    A streamed response whose body has already been read.
+
+    Everything but the body is looked up on the streamed response, so a
+    transport can still tell how many bytes it received.
+    """
+
+    def __init__(self, response, content):
+        """ Wrap the streamed response and its body. """
+        self._response = response
+        self.content = content
+
+    def __getattr__(self, name):
+        """ Look up everything else on the streamed response. """
+        return getattr(self._response, name)
+
+    def json(self):
+        """ Decode the response body as JSON. """
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=1):
+        """ Iterate over the response body. """
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        """ Close the streamed response. """
+        self._response.close()
+
+
+class HTTP2Transport(Transport):
+
+    """
+    A HTTP/2 transport that multiplexes requests over a few connections.
+
+    Concurrent requests to the same host share a connection instead of
+    opening one each. Requires ``httpx`` with HTTP/2 support, installed with
+    ``pip install httpx[http2]``.
+    """
+
+    def __init__(self, max_connections=10):
+        """ Initialize the httpx client. """
+        if httpx is None:
+            raise ImportError(
+                'HTTP2Transport requires httpx, install httpx[http2].')
+        self.client = httpx.Client(
+            http2=True, limits=httpx.Limits(max_connections=max_connections))
+
+    def request(self, method, url, auth=None, headers=None, data=None,
+                stream=False, timeout=None):
+        """ Send a request through the httpx client. """
+        request = self.client.build_request(
+            method, url, headers=headers, content=data, timeout=timeout)
+        try:
+            response = self.client.send(request, auth=auth, stream=stream)
+        except httpx.TimeoutException as e:
+            raise TransportTimeout(e)
+        return HTTP2Response(response)
+
+    def received_bytes(self, response):
+        """ Return the number of body bytes that came over the wire. """
+        return response.response.num_bytes_downloaded
+
+    def decoded_encodings(self, url):
+        """ Return the content encodings that httpx decodes. """
+        decoders = getattr(httpx, '_decoders', None)
+        return [encoding for encoding in
+                getattr(decoders, 'SUPPORTED_DECODERS', ['gzip'])
+                if encoding != 'identity']
+
+    def close(self):
+        """ Close the httpx client and its connections. """
+        self.client.close()
+
+
+class TransportRegistry(object):
+
+    """
+    Share transports, and their connection pools, between clients.
+
+    The registry keeps one transport per scheme and host, so clients for
+    many tenants on the same host reuse warm connections whatever their
+    credentials. Transports that have not been used for ``idle_timeout``
+    seconds are closed, and created again when they are needed.
+
+    :param factory: Creates a new transport. Defaults to a
+        :class:`RequestsTransport` that keeps at most ``max_connections``
+        connections to the host pooled and does not store cookies. More
+        connections are opened when they are all in use, rather than
+        waiting for one without a timeout.
+    """
+
+    def __init__(self, factory=None, max_connections=10, idle_timeout=300):
+        """ Initialize an empty registry. """
+        self.factory = factory or (lambda: RequestsTransport(
+            pool_maxsize=max_connections, pool_block=False,
+            store_cookies=False))
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._transports = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def key(url):
+        """ Return the registry key, scheme and host, of a URL. """
+        parts = urlsplit(url)
+        return parts.scheme.lower(), parts.netloc.lower()
+
+    def acquire(self, url):
+        """ Return the transport for the host of ``url`` and mark it busy. """
+        key = self.key(url)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections can not be shared with the parent of a fork.
+                self._transports = {}
+                self._pid = os.getpid()
+            self._evict_idle()
+            entry = self._transports.get(key)
+            if entry is None:
+                entry = self._transports[key] = {
+                    'transport': self.factory(), 'busy': 0}
+            entry['busy'] += 1
+            entry['used'] = time.time()
+            return entry['transport']
+
+    def release(self, url):
+        """ Mark a request to the host of ``url`` as finished. """
+        with self._lock:
+            entry = self._transports.get(self.key(url))
+            if entry is not None:
+                entry['busy'] -= 1
+                entry['used'] = time.time()
+
+    def _evict_idle(self):
+        """ Close the transports that have been idle for too long. """
+        now = time.time()
+        for key, entry in list(self._transports.items()):
+            if not entry['busy'] and \
+                    now - entry['used'] >= self.idle_timeout:
+                entry['transport'].close()
+                del self._transports[key]
+
+    def evict_idle(self):
+        """ Close the transports that have been idle for too long. """
+        with self._lock:
+            self._evict_idle()
+
+    def close(self):
+        """ Close all the transports in the registry. """
+        with self._lock:
+            for entry in self._transports.values():
+                entry['transport'].close()
+            self._transports = {}
+
+
+class SharedTransport(Transport):
+
+    """ A transport that sends requests through a transport registry. """
+
+    def __init__(self, registry):
+        """ Initialize the transport with the registry to use. """
+        self.registry = registry
+
+    def request(self, method, url, auth=None, headers=None, data=None,
+                stream=False, timeout=None):
+        """
+        Send a request through the shared transport of the host.
+
+        The transport is busy, and is not evicted, until the response has
+        been read or, for a stream, closed.
+        """
+        transport = self.registry.acquire(url)
+        try:
+            response = transport.request(
+                method, url, auth=auth, headers=headers, data=data,
+                stream=stream, timeout=timeout)
+        except BaseException:
+            self.registry.release(url)
+            raise
+        response.transport = transport
+        if not stream:
+            self.registry.release(url)
+            return response
+        close, released = response.close, []
+
+        def release_on_close():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.registry.release(url)
+        response.close = release_on_close
+        return response
+
+    def received_bytes(self, response):
+        """ Return the number of body bytes that came over the wire. """
+        return response.transport.received_bytes(response)
+
+    def decoded_encodings(self, url):
+        """ Return the encodings the shared transport of the host decodes. """
+        transport = self.registry.acquire(url)
+        try:
+            return transport.decoded_encodings(url)
+        finally:
+            self.registry.release(url)
+
+    def close(self):
+        """ Leave the shared connections open for other clients. """
+        pass
+
+
+# The registry that clients share unless they are given a transport.
+registry = TransportRegistry()
@@ -0,0 +1,212 @@
+""" Watch listings for changes and tell subscribers about them. """
+
+import heapq
+import logging
+import random
+import threading
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from .throttle import RateLimiter, clock
+
+logger = logging.getLogger(__name__)
+
+
+class Event(namedtuple('Event', ['kind', 'entity', 'object'])):
+
+    """
+    A change to an object in a watched listing.
+
+    ``kind`` is 'created', 'updated' or 'deleted'. Deleted objects are only
+    known by id, so their ``object`` is ``{'id': id}``.
+    """
+
+    __slots__ = ()
+
+
+class Feed(object):
+
+    """ A watched listing and what the watcher knows about it. """
+
+    def __init__(self, entity, search_terms, interval):
+        """ Initialize a feed that has not been polled. """
+        self.entity = entity
+        self.search_terms = search_terms or {}
+        self.interval = interval
+        # The modified time of every object by id.
+        self.snapshot = None
+        self.last_modified = None
+        self.polls = 0
+
+
+class Watcher(object):
+
+    """
+    Poll many listings on a schedule and publish what changed.
+
+    Every watched listing, a feed, is polled every ``interval`` seconds,
+    give or take ``jitter`` so polls spread out. The first poll of a feed
+    fetches the whole listing as a snapshot. Later polls only fetch objects
+    that were modified since the newest one seen, with a
+    ``modified__gte`` filter, and compare them to the snapshot. Deleted
+    objects only show up in a full listing, which is fetched every
+    ``full_sync_every`` polls.
+
+    Polls run on ``concurrency`` threads and request at most ``rate`` pages
+    a second across all feeds::
+
+        watcher = Watcher(client, rate=20)
+        watcher.watch(Entity.Tasks, {'space': space_id}, interval=30)
+        watcher.subscribe(notify)
+        watcher.start()
+
+    Subscribers are called with every :class:`Event` from the polling
+    threads. Errors of subscribers and polls are logged and counted in the
+    client's stats as ``watch_subscriber_errors`` and ``watch_errors``.
+    """
+
+    def __init__(self, client, rate=10, concurrency=4, jitter=0.1,
+                 full_sync_every=10, modified_field='modified'):
+        """ Initialize a watcher without feeds. """
+        self.client = client
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.full_sync_every = full_sync_every
+        self.modified_field = modified_field
+        self.subscribers = []
+        self._schedule = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        # Feeds that were taken off the schedule to be polled.
+        self._in_flight = set()
+
+    def watch(self, entity, search_terms=None, interval=60):
+        """ Start watching a listing and return its feed. """
+        feed = Feed(entity, search_terms, interval)
+        self._reschedule(feed, delay=0)
+        return feed
+
+    def subscribe(self, callback):
+        """ Call ``callback`` with every event. """
+        self.subscribers.append(callback)
+
+    def _reschedule(self, feed, delay=None):
+        """ Schedule the next poll of a feed. """
+        if delay is None:
+            delay = feed.interval * random.uniform(
+                1 - self.jitter, 1 + self.jitter)
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(
+                self._schedule, (clock() + delay, self._counter, feed))
+            self._condition.notify()
+
+    def poll(self, feed):
+        """ Poll a feed once and return the events. """
+        full = feed.snapshot is None or bool(
+            self.full_sync_every and feed.polls % self.full_sync_every == 0)
+        terms = dict(feed.search_terms)
+        if not full and feed.last_modified:
+            terms[self.modified_field + '__gte'] = feed.last_modified
+        snapshot = feed.snapshot or {}
+        current, events = {}, []
+        last_modified = feed.last_modified
+        for obj in self.client.iter_objects(
+                feed.entity, limit=100, search_terms=terms,
+                limiter=self.limiter):
+            id, modified = obj['id'], obj.get(self.modified_field)
+            current[id] = modified
+            if feed.snapshot is not None:
+                if id not in snapshot:
+                    events.append(Event('created', feed.entity, obj))
+                elif snapshot[id] != modified:
+                    events.append(Event('updated', feed.entity, obj))
+            if modified and (last_modified is None or
+                             modified > last_modified):
+                last_modified = modified
+        # Only change the feed once the whole poll has succeeded.
+        if full:
+            if feed.snapshot is not None:
+                for id in set(snapshot) - set(current):
+                    events.append(Event('deleted', feed.entity, {'id': id}))
+            feed.snapshot = current
+        else:
+            feed.snapshot.update(current)
+        feed.last_modified = last_modified
+        feed.polls += 1
+        return events
+
+    def publish(self, events):
+        """ Tell the subscribers about events. """
+        for event in events:
+            for callback in self.subscribers:
+                # One failing subscriber must not keep the event from others.
+                try:
+                    callback(event)
+                except Exception:
+                    self.client.stats.incr('watch_subscriber_errors')
+                    logger.exception('Subscriber %r failed on %r',
+                                     callback, event)
+
+    def _poll(self, feed):
+        """ Poll a feed, publish the events and schedule the next poll. """
+        try:
+            self.publish(self.poll(feed))
+        except Exception:
+            self.client.stats.incr('watch_errors')
+            logger.exception('Polling %s failed', feed.entity.value)
+        finally:
+            with self._condition:
+                # Unless stop() has scheduled it already.
+                if feed in self._in_flight:
+                    self._in_flight.remove(feed)
+                    self._reschedule(feed)
+
+    def run(self):
+        """ Poll the feeds until :meth:`stop` is called. """
+        pool = ThreadPool(self.concurrency)
+        try:
+            while True:
+                with self._condition:
+                    while not self._stopped and (
+                            not self._schedule or
+                            self._schedule[0][0] > clock()):
+                        timeout = None
+                        if self._schedule:
+                            timeout = self._schedule[0][0] - clock()
+                        self._condition.wait(timeout)
+                    if self._stopped:
+                        return
+                    feed = heapq.heappop(self._schedule)[2]
+                    self._in_flight.add(feed)
+                pool.apply_async(self._poll, (feed,))
+        finally:
+            pool.terminate()
+
+    def start(self):
+        """ Poll the feeds in a background thread. """
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop polling.
+
+        Feeds that were still being polled are put back on the schedule so
+        they are polled first when the watcher is started again.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            for feed in self._in_flight:
+                self._reschedule(feed, delay=0)
+            self._in_flight.clear()
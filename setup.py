@@ -21,4 +21,12 @@ setup(
         'requests==2.3.0',
         'enum34==1.0'
     ],
+    entry_points={
+        'console_scripts': ['coredata = coredata.cli:main'],
+    },
+    extras_require={
+        'http2': ['httpx[http2]'],
+        'brotli': ['brotli'],
+        'zstd': ['zstandard'],
+    },
 )
@@ -1,10 +1,31 @@
+import copy
+import gc
 import glob
+import gzip
+import hashlib
 import json
+import pickle
+import re
 import httpretty
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from nose.tools import raises
 from unittest import TestCase, SkipTest, skip
-from coredata import CoredataClient, Entity, CoredataError
+from coredata import cli
+from coredata.transport import TransportTimeout
+from coredata.coredata import Utils
+from coredata.throttle import clock
+from coredata import (
+    CoredataClient, Entity, CoredataError, CoredataTimeout, RequestsTransport,
+    HTTP2Transport, Crawler, PageParser, Interner, TransportRegistry,
+    SharedTransport, TokenAuth, BlobCache, Migration, MigrationError, Ref,
+    SpooledListing, Watcher, Event, Profile, Transport)
 
 
 def skipIfInList(action):
@@ -620,3 +641,1486 @@ class TestValuelist(TestCase, EntityTestCase):
             content_type="application/json; charset=utf-8")
         entities = self.client.get(self.entity, 'templates_labels')
         self.assertEqual(len(entities['objects'][0]['entries']), 28)
+
+
+@httpretty.activate
+class TestGetMany(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+        data = json.loads(open('tests/json/get_all_files1.json').read())
+        self.objects = data['objects']
+        self.ids = [obj['id'] for obj in self.objects]
+
+    def test_get_many_with_id_in(self):
+        def respond(request, uri, headers):
+            ids = request.querystring['id__in'][0].split(',')
+            objects = [obj for obj in self.objects if obj['id'] in ids]
+            body = {'meta': {'next': None, 'total_count': len(objects)},
+                    'objects': objects}
+            return 200, headers, json.dumps(body)
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        ids = list(reversed(self.ids[:3])) + ['missing-id']
+        objects, missing = self.client.get_many(Entity.Files, ids)
+        self.assertEqual([obj['id'] for obj in objects], ids[:3])
+        self.assertEqual(missing, ['missing-id'])
+        self.assertTrue(self.client.supports_id_in)
+
+    def test_get_many_follows_capped_pages(self):
+        objects = all_files()[:40]
+
+        def respond(request, uri, headers):
+            ids = request.querystring['id__in'][0].split(',')
+            offset = int(request.querystring['offset'][0])
+            matches = [obj for obj in objects if obj['id'] in ids]
+            # The server returns at most 20 objects per page.
+            page = matches[offset:offset + 20]
+            next_path = None
+            if offset + 20 < len(matches):
+                next_path = '/api/v2/files/?limit=20&offset={0}'.format(
+                    offset + 20)
+            body = {'meta': {'next': next_path,
+                             'total_count': len(matches)},
+                    'objects': page}
+            return 200, headers, json.dumps(body)
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        ids = [obj['id'] for obj in objects]
+        found, missing = self.client.get_many(Entity.Files, ids)
+        self.assertEqual([obj['id'] for obj in found], ids)
+        self.assertEqual(missing, [])
+        self.assertTrue(self.client.supports_id_in)
+
+    def test_get_many_chunks_long_id_lists(self):
+        requested = []
+
+        def respond(request, uri, headers):
+            ids = request.querystring['id__in'][0].split(',')
+            requested.append(ids)
+            body = {'meta': {'next': None, 'total_count': 0}, 'objects': []}
+            return 200, headers, json.dumps(body)
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        ids = ['{0:036d}'.format(i) for i in range(200)]
+        objects, missing = self.client.get_many(Entity.Files, ids)
+        self.assertTrue(len(requested) > 1)
+        self.assertEqual(sorted(sum(requested, [])), ids)
+        self.assertEqual(missing, ids)
+
+    def test_get_many_falls_back_to_single_gets(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, status=400,
+            content_type="application/json; charset=utf-8")
+        for obj in self.objects[:2]:
+            httpretty.register_uri(
+                httpretty.GET, self.url + obj['id'] + '/',
+                body=json.dumps(obj),
+                content_type="application/json; charset=utf-8")
+        httpretty.register_uri(
+            httpretty.GET, self.url + 'missing-id/', status=404,
+            content_type="application/json; charset=utf-8")
+        ids = ['missing-id'] + self.ids[:2]
+        objects, missing = self.client.get_many(Entity.Files, ids)
+        self.assertEqual([obj['id'] for obj in objects], self.ids[:2])
+        self.assertEqual(missing, ['missing-id'])
+        self.assertFalse(self.client.supports_id_in)
+
+
+@httpretty.activate
+class TestTransport(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def register_listing(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url,
+            body=open('tests/json/get_files_filtering.json').read(),
+            content_type="application/json; charset=utf-8")
+
+    def test_custom_transport(self):
+        methods = []
+
+        class RecordingTransport(RequestsTransport):
+            def request(self, method, url, **kwargs):
+                methods.append(method)
+                return super(RecordingTransport, self).request(
+                    method, url, **kwargs)
+        self.register_listing()
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=RecordingTransport())
+        self.assertEqual(len(client.get(Entity.Files)), 6)
+        self.assertEqual(methods, ['GET'])
+
+    def test_http2_transport(self):
+        try:
+            transport = HTTP2Transport()
+        except ImportError:
+            raise SkipTest('httpx is not installed.')
+        self.register_listing()
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=transport)
+        self.assertEqual(len(client.get(Entity.Files)), 6)
+        transport.close()
+
+
+@httpretty.activate
+class TestCompression(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            compression=['gzip'], compress_requests='gzip')
+
+    def test_compressed_listing(self):
+        body = open('tests/json/get_all_files1.json', 'rb').read()
+        data = json.loads(body.decode('utf-8'))
+        data['meta']['next'] = None
+        body = json.dumps(data).encode('utf-8')
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=gzip.compress(body),
+            adding_headers={'content-encoding': 'gzip'},
+            content_type="application/json; charset=utf-8")
+        r = self.client.get(Entity.Files)
+        self.assertEqual(len(r), 20)
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['accept-encoding'], 'gzip')
+        self.assertEqual(self.client.stats['bytes_received'], len(body))
+        self.assertTrue(self.client.stats.received_compression_ratio > 1)
+
+    def test_only_decoded_encodings_are_accepted(self):
+        class GzipTransport(RequestsTransport):
+            def decoded_encodings(self, url):
+                return ['gzip', 'deflate']
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=GzipTransport(), compression=True)
+        self.assertEqual(client.headers['accept-encoding'], 'gzip')
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'), compression=True)
+        self.assertTrue(set(client.headers['accept-encoding'].split(', ')) <=
+                        set(RequestsTransport().decoded_encodings(self.host)))
+        with self.assertRaises(ValueError):
+            CoredataClient(
+                host=self.host, auth=('username', 'password'),
+                transport=GzipTransport(), compression=['br', 'gzip'])
+
+    def test_compressed_payload(self):
+        httpretty.register_uri(
+            httpretty.POST, self.url, status=201,
+            location='http://example.coredata.is/doc/derp',
+            content_type="application/json; charset=utf-8")
+        payload = {'title': 'Yolo ' * 100}
+        self.client.create(Entity.Files, payload)
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['content-encoding'], 'gzip')
+        self.assertEqual(
+            json.loads(gzip.decompress(request.body).decode('utf-8')),
+            payload)
+        self.assertTrue(self.client.stats.sent_compression_ratio > 1)
+
+    @raises(ValueError)
+    def test_unsupported_payload_encoding(self):
+        CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            compress_requests='lzma')
+
+
+def listing_callback(objects):
+    """ Serve a paginated listing of ``objects`` like Coredata does. """
+    def respond(request, uri, headers):
+        offset = int(request.querystring.get('offset', ['0'])[0])
+        limit = int(request.querystring.get('limit', ['20'])[0])
+        page = objects[offset:offset + limit]
+        next_path = None
+        if offset + limit < len(objects):
+            next_path = '/api/v2/files/?limit={limit}&offset={offset}'.format(
+                limit=limit, offset=offset + limit)
+        body = {'meta': {'limit': limit, 'offset': offset,
+                         'total_count': len(objects), 'next': next_path},
+                'objects': page}
+        return 200, headers, json.dumps(body)
+    return respond
+
+
+def all_files():
+    """ Return the 45 files from the paginated fixtures. """
+    objects = []
+    for f in sorted(glob.glob('tests/json/get_all_files*.json')):
+        objects.extend(json.loads(open(f).read())['objects'])
+    return objects
+
+
+def file_id(obj):
+    return obj['id']
+
+
+@httpretty.activate
+class TestCrawler(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        self.objects = all_files()
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(self.objects),
+            content_type="application/json; charset=utf-8")
+        self.crawler = Crawler(
+            self.host, ('username', 'password'), processes=2, page_size=4,
+            pages_per_batch=2, transform=file_id)
+
+    def test_tasks(self):
+        tasks = self.crawler.tasks(Entity.Files)
+        self.assertEqual(len(tasks), 6)
+        self.assertEqual(tasks[-1][2:4], (40, 45))
+
+    def test_crawl(self):
+        batches = list(self.crawler.crawl(Entity.Files, ordered=True))
+        self.assertEqual(sum(batches, []), [o['id'] for o in self.objects])
+
+    def test_crawl_to_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            shards = self.crawler.crawl_to_files(Entity.Files, directory)
+            self.assertEqual(sum(count for _, count in shards), 45)
+            ids = []
+            for path, _ in shards:
+                ids.extend(json.loads(line) for line in open(path))
+            self.assertEqual(ids, [o['id'] for o in self.objects])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestPageParser(TestCase):
+    def chunks(self, data, size):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_parse_in_small_chunks(self):
+        data = open('tests/json/get_all_files1.json', 'rb').read()
+        expected = json.loads(data.decode('utf-8'))
+        for size in (1, 7, 4096):
+            parser = PageParser(self.chunks(data, size))
+            self.assertEqual(list(parser), expected['objects'])
+            self.assertEqual(parser.meta, expected['meta'])
+
+    def test_meta_after_objects(self):
+        data = b'{"objects": [1, 22, {"a": [3]}], "meta": {"next": null}}'
+        parser = PageParser(self.chunks(data, 3))
+        self.assertEqual(list(parser), [1, 22, {'a': [3]}])
+        self.assertEqual(parser.meta, {'next': None})
+
+    def test_strings_with_brackets_and_escapes(self):
+        objects = [{'a': 'x]}"\\', 'b': ['"[{', '\\"']}, '}]', {}]
+        data = json.dumps({'objects': objects}).encode('utf-8')
+        for size in (1, 2, 5):
+            self.assertEqual(list(PageParser(self.chunks(data, size))),
+                             objects)
+
+    def test_values_are_decoded_once(self):
+        decoded = []
+
+        class CountingDecoder(json.JSONDecoder):
+            def raw_decode(self, s, idx=0):
+                decoded.append(idx)
+                return super(CountingDecoder, self).raw_decode(s, idx)
+        objects = [{'title': 'x' * 10000, 'tags': list(range(1000))}] * 2
+        data = json.dumps({'objects': objects}).encode('utf-8')
+        parser = PageParser(self.chunks(data, 16))
+        parser.decoder = CountingDecoder()
+        self.assertEqual(list(parser), objects)
+        # The key and the two objects.
+        self.assertEqual(len(decoded), 3)
+
+    def test_empty_page(self):
+        data = open('tests/json/empty.json', 'rb').read()
+        parser = PageParser([data])
+        self.assertEqual(list(parser), [])
+        self.assertEqual(parser.meta['total_count'], 0)
+
+    @raises(ValueError)
+    def test_truncated_page(self):
+        data = open('tests/json/get_all_files1.json', 'rb').read()
+        list(PageParser(self.chunks(data[:-100], 64)))
+
+
+@httpretty.activate
+class TestIterObjects(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+
+    def test_iter_objects(self):
+        objects = all_files()
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(objects),
+            content_type="application/json; charset=utf-8")
+        r = list(self.client.iter_objects(
+            Entity.Files, limit=10, search_terms={'category': 'main'}))
+        self.assertEqual(r, objects)
+        request = httpretty.last_request()
+        self.assertEqual(request.querystring['category'], ['main'])
+        self.assertEqual(request.querystring['offset'], ['40'])
+
+    def test_null_objects_do_not_end_the_page(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url,
+            body=json.dumps({'meta': {'next': None, 'total_count': 3},
+                             'objects': [{'id': 'a'}, None, {'id': 'b'}]}),
+            content_type="application/json; charset=utf-8")
+        self.assertEqual(list(self.client.iter_objects(Entity.Files)),
+                         [{'id': 'a'}, None, {'id': 'b'}])
+
+    def test_stats_count_streamed_bytes(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(all_files()),
+            content_type="application/json; charset=utf-8")
+        self.client.get(Entity.Files)
+        for i in range(2):
+            list(self.client.iter_objects(Entity.Files))
+        stats = self.client.stats
+        self.assertTrue(stats['bytes_received'] > 0)
+        self.assertEqual(stats['bytes_received_wire'],
+                         stats['bytes_received'])
+        self.assertEqual(stats.received_compression_ratio, 1.0)
+
+    def test_get_keeps_filters_on_every_page(self):
+        objects = all_files()
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(objects),
+            content_type="application/json; charset=utf-8")
+        r = self.client.get(
+            Entity.Files, limit=10, search_terms={'category': 'main'})
+        self.assertEqual(r, objects)
+        requests = httpretty.latest_requests()
+        self.assertEqual(len(requests), 5)
+        for request in requests:
+            self.assertEqual(request.querystring['category'], ['main'])
+            self.assertEqual(request.querystring['limit'], ['10'])
+            self.assertEqual(request.querystring['sync'], ['true'])
+
+    def test_get_follows_next_cursor(self):
+        objects = all_files()
+
+        def respond(request, uri, headers):
+            cursor = int(request.querystring.get('cursor', ['0'])[0])
+            page = objects[cursor:cursor + 20]
+            meta = {'next': '/ignored/', 'total_count': len(objects),
+                    'next_cursor': None}
+            if cursor + 20 < len(objects):
+                meta['next_cursor'] = str(cursor + 20)
+            else:
+                meta['next'] = None
+            return 200, headers, json.dumps({'meta': meta, 'objects': page})
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        r = self.client.get(Entity.Files)
+        self.assertEqual(r, objects)
+        requests = httpretty.latest_requests()
+        self.assertEqual(len(requests), 3)
+        for request in requests[1:]:
+            self.assertNotIn('offset', request.querystring)
+
+    @raises(CoredataError)
+    def test_iter_objects_error(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, status=500,
+            body=json.dumps({'error_message': 'There was a error!'}),
+            content_type="application/json; charset=utf-8")
+        list(self.client.iter_objects(Entity.Files))
+
+
+class TestInterner(TestCase):
+    def test_shares_repeated_values(self):
+        objects = all_files()
+        interner = Interner()
+        for obj in objects:
+            interner.intern(obj)
+        self.assertEqual(
+            json.loads(json.dumps(objects)), all_files())
+        self.assertIs(objects[0]['dynatype'], objects[1]['dynatype'])
+        self.assertIs(objects[0]['created_by'], objects[1]['created_by'])
+        self.assertIsInstance(objects[0]['tags'], tuple)
+        self.assertTrue(interner.bytes_saved > 0)
+
+    def test_shared_keys_are_counted_once(self):
+        key = 'key' * 20
+        body = json.dumps([{key: i} for i in range(1000)])
+        interner = Interner()
+        for page in range(2):
+            seen = {}
+            for obj in json.loads(body):
+                interner.intern(obj, seen)
+        # Only the key of the second page was replaced.
+        self.assertTrue(interner.bytes_saved <= sys.getsizeof(key))
+
+    def test_structure_is_compared_by_type(self):
+        interner = Interner()
+        a = interner.intern({'x': {'value': 1}})
+        b = interner.intern({'x': {'value': True}})
+        self.assertIsNot(a['x'], b['x'])
+        self.assertIs(b['x']['value'], True)
+
+    @raises(TypeError)
+    def test_shared_values_are_read_only(self):
+        obj = Interner().intern({'dynatype': {'id': 'derp'}})
+        obj['dynatype']['id'] = 'herp'
+
+    def test_shared_values_can_be_copied(self):
+        obj = Interner().intern({'dynatype': {'id': 'derp'}})
+        self.assertEqual(copy.deepcopy(obj), obj)
+        self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+
+
+@httpretty.activate
+class TestInterning(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def test_get_with_interner(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(all_files()),
+            content_type="application/json; charset=utf-8")
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            interner=Interner())
+        r = client.get(Entity.Files)
+        self.assertIs(r[0]['dynatype'], r[-1]['dynatype'])
+        self.assertTrue(client.interner.bytes_saved > 0)
+
+
+@httpretty.activate
+class TestCommandLine(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+    options = ['--host', host, '--username', 'username', '--password',
+               'password', '--progress', '0']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = io.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        objects = all_files()
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(objects),
+            content_type="application/json; charset=utf-8")
+        path = os.path.join(self.directory, 'files.ndjson.gz')
+        code = cli.main(self.options + [
+            'export', 'files', '--filter', 'category=main', '-o', path])
+        self.assertEqual(code, 0)
+        lines = gzip.open(path).read().decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], objects)
+        request = httpretty.last_request()
+        self.assertEqual(request.querystring['category'], ['main'])
+
+    def test_import_with_failures(self):
+        objects = all_files()[:6]
+        del objects[0]['id']
+        httpretty.register_uri(
+            httpretty.POST, self.url, status=201,
+            location='http://example.coredata.is/doc/derp',
+            content_type="application/json; charset=utf-8")
+        for obj in objects[1:]:
+            httpretty.register_uri(
+                httpretty.PUT, self.url + obj['id'] + '/', status=204,
+                content_type="application/json; charset=utf-8")
+        httpretty.register_uri(
+            httpretty.PUT, self.url + objects[-1]['id'] + '/', status=500,
+            body=json.dumps({'error_message': 'No way, Jose'}),
+            content_type="application/json; charset=utf-8")
+        httpretty.register_uri(
+            httpretty.PUT, self.url + objects[-2]['id'] + '/', status=404,
+            content_type="application/json; charset=utf-8")
+        path = os.path.join(self.directory, 'files.ndjson')
+        failures = os.path.join(self.directory, 'failures.ndjson')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for obj in objects:
+                f.write(json.dumps(obj, ensure_ascii=False) + u'\n')
+        code = cli.main(self.options + [
+            'import', 'files', '-i', path, '--concurrency', '2',
+            '--mode', 'auto', '--failures', failures])
+        self.assertEqual(code, 1)
+        paths = set(r.path.split('?')[0] for r in httpretty.latest_requests())
+        self.assertEqual(len(paths), 6)
+        failed = [json.loads(line) for line in io.open(failures)]
+        self.assertEqual(sorted(failed, key=file_id),
+                         sorted(objects[-2:], key=file_id))
+
+    def test_import_creates_by_default(self):
+        httpretty.register_uri(
+            httpretty.POST, self.url, status=201,
+            location='http://example.coredata.is/doc/derp',
+            content_type="application/json; charset=utf-8")
+        path = os.path.join(self.directory, 'files.ndjson')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for obj in all_files()[:3]:
+                f.write(json.dumps(obj, ensure_ascii=False) + u'\n')
+        code = cli.main(self.options + ['import', 'files', '-i', path])
+        self.assertEqual(code, 0)
+        self.assertEqual(
+            set(r.method for r in httpretty.latest_requests()), set(['POST']))
+
+
+@httpretty.activate
+class TestTransportRegistry(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url,
+            body=open('tests/json/get_files_filtering.json').read(),
+            set_cookie='sessionid=secret',
+            content_type="application/json; charset=utf-8")
+        self.registry = TransportRegistry()
+
+    def tearDown(self):
+        self.registry.close()
+
+    def client(self, auth, host=None):
+        return CoredataClient(
+            host=host or self.host, auth=auth,
+            transport=SharedTransport(self.registry))
+
+    def test_clients_share_transports_per_host(self):
+        a = self.registry.acquire(self.url)
+        b = self.registry.acquire('HTTPS://Example.Coredata.is/api/v2/')
+        c = self.registry.acquire('https://other.coredata.is/api/v2/')
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+
+    def test_shared_transports_do_not_keep_cookies(self):
+        first = self.client(('tenant1', 'password'))
+        second = self.client(('tenant2', 'password'))
+        self.assertEqual(len(first.get(Entity.Files)), 6)
+        self.assertEqual(len(second.get(Entity.Files)), 6)
+        request = httpretty.last_request()
+        self.assertNotIn('cookie', request.headers)
+        transport = self.registry.acquire(self.url)
+        self.assertEqual(len(transport.session.cookies), 0)
+
+    def test_idle_transports_are_evicted(self):
+        self.registry.idle_timeout = 0
+        client = self.client(('username', 'password'))
+        client.get(Entity.Files)
+        transport = self.registry.acquire(self.url)
+        self.registry.release(self.url)
+        self.registry.evict_idle()
+        self.assertIsNot(self.registry.acquire(self.url), transport)
+        self.assertEqual(len(client.get(Entity.Files)), 6)
+
+    def test_streamed_responses_keep_the_transport_busy(self):
+        self.registry.idle_timeout = 0
+        shared = SharedTransport(self.registry)
+        r = shared.request('GET', self.url, stream=True)
+        self.registry.evict_idle()
+        self.assertIs(self.registry.acquire(self.url), r.transport)
+        self.registry.release(self.url)
+        r.close()
+        r.close()
+        self.assertEqual(
+            self.registry._transports[self.registry.key(self.url)]['busy'],
+            0)
+        self.registry.evict_idle()
+        self.assertIsNot(self.registry.acquire(self.url), r.transport)
+
+    def test_shared_pools_do_not_block(self):
+        transport = self.registry.acquire(self.url)
+        adapter = transport.session.get_adapter(self.url)
+        self.assertFalse(adapter._pool_block)
+
+
+@httpretty.activate
+class TestTokenAuth(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+    login_url = host + '/api/v2/user/'
+
+    def setUp(self):
+        self.logins = []
+
+        def login(request, uri, headers):
+            self.logins.append(request.headers.get('authorization'))
+            headers['set-cookie'] = 'sessionid=token{n}; Max-Age=3600'.format(
+                n=len(self.logins))
+            body = open('tests/json/get_single_user.json', 'rb').read()
+            return 200, headers, body
+        httpretty.register_uri(
+            httpretty.GET, self.login_url, body=login,
+            content_type="application/json; charset=utf-8")
+        self.auth = TokenAuth('username', 'password')
+        self.client = CoredataClient(host=self.host, auth=self.auth)
+
+    def register_listing(self, status=200):
+        def respond(request, uri, headers):
+            if request.headers.get('cookie') == 'sessionid=token1' and \
+                    status == 401:
+                return 401, headers, ''
+            body = open('tests/json/get_files_filtering.json', 'rb').read()
+            return 200, headers, body
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+
+    def test_token_is_fetched_once(self):
+        self.register_listing()
+        for i in range(3):
+            self.assertEqual(len(self.client.get(Entity.Files)), 6)
+        self.assertEqual(len(self.logins), 1)
+        self.assertTrue(self.logins[0].startswith('Basic '))
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['cookie'], 'sessionid=token1')
+        self.assertNotIn('authorization', request.headers)
+
+    def test_expiring_token_is_refreshed(self):
+        self.register_listing()
+        self.client.get(Entity.Files)
+        self.auth.refresh_margin = 3600
+        self.client.get(Entity.Files)
+        self.assertEqual(len(self.logins), 2)
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['cookie'], 'sessionid=token2')
+
+    def test_other_callers_use_token_while_it_is_refreshed(self):
+        self.register_listing()
+        self.client.get(Entity.Files)
+        self.auth.refresh_margin = 3600
+        with self.auth._lock:
+            self.client.get(Entity.Files)
+        self.assertEqual(len(self.logins), 1)
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['cookie'], 'sessionid=token1')
+
+    def test_refused_token_falls_back_to_basic_auth(self):
+        self.register_listing(status=401)
+        self.assertEqual(len(self.client.get(Entity.Files)), 6)
+        request = httpretty.last_request()
+        self.assertNotIn('cookie', request.headers)
+        self.assertTrue(request.headers['authorization'].startswith('Basic '))
+
+    def test_refused_token_keeps_request_headers(self):
+        def respond(request, uri, headers):
+            if request.headers.get('cookie'):
+                return 401, headers, ''
+            self.assertEqual(request.headers['content-encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.GzipFile(
+                fileobj=io.BytesIO(request.body)).read().decode('utf-8')),
+                {'title': 'Report'})
+            headers['location'] = self.url + 'file1'
+            return 201, headers, ''
+        httpretty.register_uri(httpretty.POST, self.url, body=respond)
+        client = CoredataClient(
+            host=self.host, auth=self.auth, compress_requests='gzip')
+        self.assertEqual(client.create(Entity.Files, {'title': 'Report'}),
+                         'file1')
+        request = httpretty.last_request()
+        self.assertNotIn('cookie', request.headers)
+        self.assertEqual(request.headers['content-encoding'], 'gzip')
+
+    def test_failed_login_falls_back_to_basic_auth(self):
+        httpretty.register_uri(
+            httpretty.GET, self.login_url, status=403,
+            content_type="application/json; charset=utf-8")
+        self.register_listing()
+        self.assertEqual(len(self.client.get(Entity.Files)), 6)
+        self.client.get(Entity.Files)
+        request = httpretty.last_request()
+        self.assertTrue(request.headers['authorization'].startswith('Basic '))
+        self.assertEqual(self.logins, [])
+
+    def test_pickle(self):
+        self.register_listing()
+        self.client.get(Entity.Files)
+        auth = pickle.loads(pickle.dumps(self.auth))
+        self.assertEqual(auth.basic, ('username', 'password'))
+        self.assertIsNone(auth._token)
+
+
+class TestBlobCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_open(self):
+        cache = BlobCache(self.directory)
+        self.assertIsNone(cache.open('abcdef01'))
+        cache.put('abcdef01', [b'herp', b'derp'])
+        blob = cache.open('abcdef01')
+        self.assertEqual(blob[:], b'herpderp')
+        blob.close()
+        self.assertIn('abcdef01', BlobCache(self.directory))
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        cache = BlobCache(self.directory, max_size=10)
+        cache.put('aaaaaaaa', [b'1234'])
+        cache.put('bbbbbbbb', [b'1234'])
+        cache.open('aaaaaaaa').close()
+        cache.put('cccccccc', [b'1234'])
+        self.assertIn('aaaaaaaa', cache)
+        self.assertNotIn('bbbbbbbb', cache)
+        self.assertFalse(os.path.exists(cache.path('bbbbbbbb')))
+        self.assertEqual(cache.size, 8)
+
+    @raises(ValueError)
+    def test_content_must_match_digest(self):
+        cache = BlobCache(self.directory)
+        try:
+            cache.put(hashlib.sha1(b'herp').hexdigest(), [b'derp'])
+        finally:
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(os.listdir(os.path.join(
+                self.directory, hashlib.sha1(b'herp').hexdigest()[:2])), [])
+
+    @raises(ValueError)
+    def test_invalid_digest(self):
+        BlobCache(self.directory).open('../../etc/passwd')
+
+
+@httpretty.activate
+class TestContentCache(TestCase):
+    host = 'https://example.coredata.is'
+    entity_id = '4ab3bb32-3e72-11e4-bfaa-ebeae41148db'
+    url = host + '/api/v2/files/' + entity_id + '/'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            blob_cache=BlobCache(self.directory))
+        self.content = open('tests/files/get_file', 'rb').read()
+        httpretty.register_uri(
+            httpretty.GET, self.url + 'content/', body=self.content)
+        self.digest = hashlib.md5(self.content).hexdigest()
+        obj = json.loads(open('tests/json/get_single_files.json').read())
+        obj['digest'] = self.digest
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=json.dumps(obj),
+            content_type="application/json; charset=utf-8")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_content_is_downloaded_once(self):
+        for i in range(2):
+            content = self.client.get(
+                Entity.Files, self.entity_id, Entity.Content)
+            self.assertEqual(content, self.content)
+        self.assertEqual(self.client.stats['blob_cache_misses'], 1)
+        self.assertEqual(self.client.stats['blob_cache_hits'], 1)
+        # The digest is asked for again.
+        self.assertEqual(self.client.stats['requests'], 3)
+
+    def test_digest_is_remembered(self):
+        self.client.digest_ttl = 60
+        for i in range(2):
+            content = self.client.get(
+                Entity.Files, self.entity_id, Entity.Content)
+            self.assertEqual(content, self.content)
+        self.assertEqual(self.client.stats['blob_cache_hits'], 1)
+        # A hit makes no request.
+        self.assertEqual(self.client.stats['requests'], 2)
+
+    def test_expired_digests_are_dropped(self):
+        self.client.digest_ttl = 0.05
+        self.client._digests['old'] = ('abcdef01', clock() - 1)
+        time.sleep(0.05)
+        self.client.get(Entity.Files, self.entity_id, Entity.Content)
+        self.assertEqual(list(self.client._digests), [self.entity_id])
+
+    def test_digest_is_forgotten_after_an_edit(self):
+        self.client.digest_ttl = 60
+        httpretty.register_uri(httpretty.PUT, self.url, status=204)
+        self.client.get(Entity.Files, self.entity_id, Entity.Content)
+        self.client.edit(Entity.Files, self.entity_id, {'title': 'Derp'})
+        self.client.get(Entity.Files, self.entity_id, Entity.Content)
+        self.assertEqual(self.client.stats['requests'], 4)
+
+    def test_content_with_known_digest(self):
+        blob = self.client.get_content(self.entity_id, digest=self.digest)
+        self.assertEqual(blob[:], self.content)
+        blob.close()
+        path = httpretty.last_request().path.split('?')[0]
+        self.assertTrue(path.endswith('/content/'))
+
+    @raises(CoredataError)
+    def test_content_that_does_not_match_is_not_cached(self):
+        digest = hashlib.md5(b'derp').hexdigest()
+        try:
+            self.client.get_content(self.entity_id, digest=digest)
+        finally:
+            self.assertNotIn(digest, self.client.blob_cache)
+            self.assertEqual(len(self.client.blob_cache), 0)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def close(self):
+        pass
+
+
+class CreatingTransport(Transport):
+    """ Creates objects in memory and records how many overlap. """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.created = []
+        self.active = self.most_active = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, auth=None, headers=None, data=None,
+                stream=False, timeout=None):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        try:
+            time.sleep(self.delay)
+            payload = json.loads(data.decode('utf-8'))
+            if payload['title'] == 'broken':
+                return FakeResponse(500, content=json.dumps(
+                    {'error_message': '#wontfix'}).encode('utf-8'))
+            with self.lock:
+                self.created.append(payload)
+            return FakeResponse(201, {
+                'location': 'http://example.coredata.is/doc/{id}'.format(
+                    id=payload['title'] + '-id')})
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class TestMigration(TestCase):
+    host = 'https://example.coredata.is'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'migration.json')
+        # httpretty is not thread safe, so the requests go to a transport
+        # that creates the objects in memory.
+        self.transport = CreatingTransport()
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=self.transport)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def migration(self):
+        migration = Migration(self.client, checkpoint=self.checkpoint)
+        migration.add('space', Entity.Spaces, {'title': 'space'})
+        migration.add('project', Entity.Projects,
+                      {'title': 'project', 'space': Ref('space')})
+        migration.add('file', Entity.Files,
+                      {'title': 'file', 'parents': [Ref('project')]})
+        migration.add('other', Entity.Spaces, {'title': 'other'})
+        return migration
+
+    def test_run(self):
+        ids = self.migration().run(concurrency=2)
+        self.assertEqual(ids, {'space': 'space-id', 'project': 'project-id',
+                               'file': 'file-id', 'other': 'other-id'})
+        titles = [payload['title'] for payload in self.transport.created]
+        self.assertTrue(titles.index('space') < titles.index('project') <
+                        titles.index('file'))
+        created = dict((p['title'], p) for p in self.transport.created)
+        self.assertEqual(created['project']['space'], 'space-id')
+        self.assertEqual(created['file']['parents'], ['project-id'])
+
+    def test_independent_entities_are_created_concurrently(self):
+        self.transport.delay = 0.05
+        migration = Migration(self.client)
+        for i in range(4):
+            key = 'space{0}'.format(i)
+            migration.add(key, Entity.Spaces, {'title': key})
+            migration.add('project' + key, Entity.Projects,
+                          {'title': 'project' + key, 'space': Ref(key)})
+        ids = migration.run(concurrency=4)
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(self.transport.most_active, 4)
+
+    def test_resume_from_checkpoint(self):
+        migration = self.migration()
+        migration.add('broken', Entity.Projects,
+                      {'title': 'broken', 'space': Ref('space')})
+        migration.add('blocked', Entity.Files,
+                      {'title': 'blocked', 'parent': Ref('broken')})
+        try:
+            migration.run()
+        except MigrationError as e:
+            self.assertEqual(list(e.errors), ['broken'])
+            self.assertEqual(e.blocked, ['blocked'])
+        else:
+            self.fail('MigrationError not raised')
+        self.transport.created = []
+        ids = self.migration().run()
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(self.transport.created, [])
+
+    @raises(ValueError)
+    def test_circular_references(self):
+        migration = Migration(self.client)
+        migration.add('a', Entity.Spaces, {'title': Ref('b')})
+        migration.add('b', Entity.Spaces, {'title': Ref('a')})
+        migration.run()
+
+    @raises(ValueError)
+    def test_unknown_reference(self):
+        migration = Migration(self.client)
+        migration.add('a', Entity.Spaces, {'title': Ref('b')})
+        migration.run()
+
+
+class TestSpooledListing(TestCase):
+    def test_sequence(self):
+        objects = all_files()
+        with SpooledListing() as listing:
+            listing.extend(objects)
+            self.assertEqual(len(listing), 45)
+            self.assertEqual(listing[0], objects[0])
+            self.assertEqual(listing[-1], objects[-1])
+            self.assertEqual(listing[10:13], objects[10:13])
+            self.assertEqual(list(listing), objects)
+            self.assertEqual(listing.get_by_id(objects[7]['id']), objects[7])
+            self.assertEqual(listing.index(objects[7]['id']), 7)
+            self.assertIsNone(listing.get_by_id('missing'))
+            listing.append({'id': 'late'})
+            self.assertEqual(listing[45], {'id': 'late'})
+            path = listing.path
+        self.assertFalse(os.path.exists(path))
+
+    def test_unclosed_listing_leaves_no_file(self):
+        listing = SpooledListing()
+        listing.extend(all_files())
+        self.assertEqual(listing[44], all_files()[44])
+        path = listing.path
+        del listing
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+    @raises(IndexError)
+    def test_index_out_of_range(self):
+        with SpooledListing() as listing:
+            listing[0]
+
+
+@httpretty.activate
+class TestSpooledGet(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def test_get_with_spool(self):
+        objects = all_files()
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(objects),
+            content_type="application/json; charset=utf-8")
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'files.spool')
+            listing = client.get(Entity.Files, spool=path)
+            self.assertEqual(len(listing), 45)
+            self.assertEqual(listing[44], objects[44])
+            listing.close()
+            self.assertTrue(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+
+@httpretty.activate
+class TestDeadlines(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(all_files()),
+            content_type="application/json; charset=utf-8")
+        self.timeouts = []
+        self.delays = []
+        test = self
+
+        class SlowTransport(RequestsTransport):
+            def request(self, method, url, **kwargs):
+                test.timeouts.append(kwargs['timeout'])
+                if test.delays:
+                    time.sleep(test.delays.pop(0))
+                return super(SlowTransport, self).request(
+                    method, url, **kwargs)
+        self.transport = SlowTransport()
+
+    def client(self, **kwargs):
+        return CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=self.transport, **kwargs)
+
+    def test_deadline_limits_every_page(self):
+        client = self.client(timeout=5)
+        with client.deadline(10):
+            self.assertEqual(len(client.get(Entity.Files)), 45)
+        self.assertEqual(len(self.timeouts), 3)
+        for timeout in self.timeouts:
+            self.assertTrue(0 < timeout <= 5)
+        client.get(Entity.Files)
+        self.assertEqual(self.timeouts[-1], 5)
+
+    def test_deadline_limits_worker_threads(self):
+        httpretty.register_uri(
+            httpretty.GET, re.compile(self.url + r'\w/'), status=404)
+        client = self.client()
+        with client.deadline(10):
+            # The server ignores id__in so the files are fetched one by one.
+            client.get_many(Entity.Files, ['a', 'b'])
+            client.facets(Entity.Files, 'mime_type', ['a', 'b', 'c'])
+        self.assertEqual(len(self.timeouts), 6)
+        for timeout in self.timeouts:
+            self.assertTrue(0 < timeout <= 10)
+
+    def test_login_has_a_timeout(self):
+        httpretty.register_uri(
+            httpretty.GET, self.host + '/api/v2/user/',
+            adding_headers={'set-cookie': 'sessionid=token; Max-Age=60'},
+            body='{}', content_type="application/json; charset=utf-8")
+        client = CoredataClient(
+            host=self.host, auth=TokenAuth('username', 'password'),
+            transport=self.transport, timeout=5)
+        client.get_page(Entity.Files)
+        self.assertEqual(self.timeouts, [5, 5])
+        client = CoredataClient(
+            host=self.host, auth=TokenAuth('username', 'password'),
+            transport=self.transport)
+        client.get_page(Entity.Files)
+        self.assertEqual(self.timeouts[2:], [30, None])
+
+    @raises(CoredataTimeout)
+    def test_deadline_runs_out_during_pagination(self):
+        client = self.client()
+        self.delays = [0, 0.2]
+        with client.deadline(0.1):
+            client.get(Entity.Files)
+
+    @raises(CoredataTimeout)
+    def test_transport_timeout(self):
+        class TimeoutTransport(RequestsTransport):
+            def request(self, method, url, **kwargs):
+                raise TransportTimeout('Read timed out.')
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=TimeoutTransport())
+        client.get(Entity.Files)
+
+    @raises(CoredataTimeout)
+    def test_deadline_limits_reading_the_body(self):
+        class SlowBody(object):
+            def __init__(self, response):
+                self.response = response
+
+            def __getattr__(self, name):
+                return getattr(self.response, name)
+
+            def iter_content(self, chunk_size=1):
+                for chunk in self.response.iter_content(16):
+                    time.sleep(0.05)
+                    yield chunk
+
+        class SlowBodyTransport(RequestsTransport):
+            def request(self, method, url, **kwargs):
+                return SlowBody(super(SlowBodyTransport, self).request(
+                    method, url, **kwargs))
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=SlowBodyTransport())
+        with client.deadline(0.2):
+            client.get_page(Entity.Files)
+
+    def test_deadline_limits_waiting_for_a_hedge(self):
+        answer = threading.Event()
+
+        class StuckTransport(Transport):
+            def request(self, method, url, **kwargs):
+                answer.wait(5)
+                return FakeResponse(200, content=b'{}')
+        client = CoredataClient(
+            host=self.host, auth=('username', 'password'),
+            transport=StuckTransport(), hedge_percentile=95)
+        for i in range(20):
+            client.latencies.add(0.01)
+        started = time.time()
+        try:
+            with client.deadline(0.1):
+                self.assertRaises(
+                    CoredataTimeout, client.get_page, Entity.Files)
+        finally:
+            answer.set()
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(client.stats['timeouts'], 1)
+
+    def test_slow_requests_are_hedged(self):
+        client = self.client(hedge_percentile=95)
+        for i in range(20):
+            client.latencies.add(0.01)
+        self.delays = [0.5, 0]
+        self.assertEqual(
+            client.get_page(Entity.Files, limit=45)['meta']['total_count'],
+            45)
+        self.assertEqual(client.stats['hedged_requests'], 1)
+        self.assertEqual(client.stats['hedge_wins'], 1)
+
+    def test_fast_requests_are_not_hedged(self):
+        client = self.client(hedge_percentile=95)
+        for i in range(20):
+            client.latencies.add(5)
+        client.get_page(Entity.Files)
+        self.assertEqual(client.stats['hedged_requests'], 0)
+        self.assertEqual(len(self.timeouts), 1)
+
+
+@httpretty.activate
+class TestWatcher(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/tasks/'
+
+    def setUp(self):
+        self.tasks = {}
+        for i in range(3):
+            id = 'task{0}'.format(i)
+            self.tasks[id] = {
+                'id': id, 'modified': '2014-09-20T00:0{0}:00'.format(i)}
+        self.queries = []
+
+        def respond(request, uri, headers):
+            self.queries.append(request.querystring)
+            since = request.querystring.get('modified__gte', [''])[0]
+            objects = sorted(
+                (task for task in self.tasks.values()
+                 if task['modified'] >= since), key=lambda t: t['id'])
+            offset = int(request.querystring['offset'][0])
+            limit = int(request.querystring['limit'][0])
+            next_path = None
+            if offset + limit < len(objects):
+                next_path = '/api/v2/tasks/?limit={0}&offset={1}'.format(
+                    limit, offset + limit)
+            body = {'meta': {'next': next_path,
+                             'total_count': len(objects)},
+                    'objects': objects[offset:offset + limit]}
+            return 200, headers, json.dumps(body)
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+        self.watcher = Watcher(self.client, rate=None, full_sync_every=3)
+        self.events = []
+        self.watcher.subscribe(self.events.append)
+
+    def test_poll(self):
+        feed = self.watcher.watch(Entity.Tasks, {'space': 'derp'})
+        self.assertEqual(self.watcher.poll(feed), [])
+        self.assertEqual(len(feed.snapshot), 3)
+        self.tasks['task1']['modified'] = '2014-09-21T00:00:00'
+        self.tasks['task3'] = {'id': 'task3',
+                               'modified': '2014-09-21T00:00:00'}
+        events = self.watcher.poll(feed)
+        self.assertEqual(
+            [(event.kind, event.object['id']) for event in events],
+            [('updated', 'task1'), ('created', 'task3')])
+        self.assertEqual(self.queries[-1]['modified__gte'],
+                         ['2014-09-20T00:02:00'])
+        self.assertEqual(self.queries[-1]['space'], ['derp'])
+        del self.tasks['task0']
+        self.assertEqual(self.watcher.poll(feed), [])
+        events = self.watcher.poll(feed)
+        self.assertNotIn('modified__gte', self.queries[-1])
+        self.assertEqual(events, [Event('deleted', Entity.Tasks,
+                                        {'id': 'task0'})])
+
+    def test_every_page_is_rate_limited(self):
+        class Limiter(object):
+            acquired = 0
+
+            def acquire(self):
+                self.acquired += 1
+        self.watcher.limiter = Limiter()
+        for i in range(3, 250):
+            id = 'task{0}'.format(i)
+            self.tasks[id] = {'id': id, 'modified': '2014-09-20T00:00:00'}
+        feed = self.watcher.watch(Entity.Tasks)
+        self.watcher.poll(feed)
+        self.assertEqual(len(feed.snapshot), 250)
+        self.assertEqual(self.watcher.limiter.acquired, 3)
+
+    def test_failing_subscriber(self):
+        def fail(event):
+            raise ValueError(event)
+        self.watcher.subscribers.insert(0, fail)
+        events = [Event('created', Entity.Tasks, {'id': 'task0'}),
+                  Event('deleted', Entity.Tasks, {'id': 'task1'})]
+        self.watcher.publish(events)
+        self.assertEqual(self.events, events)
+        self.assertEqual(self.client.stats['watch_subscriber_errors'], 2)
+
+    def test_feeds_polled_during_stop_are_rescheduled(self):
+        polling, release = threading.Event(), threading.Event()
+
+        class BlockingWatcher(Watcher):
+            def poll(self, feed):
+                polling.set()
+                release.wait()
+                return []
+        watcher = BlockingWatcher(self.client, rate=None)
+        feed = watcher.watch(Entity.Tasks, interval=60)
+        watcher.start()
+        self.assertTrue(polling.wait(5))
+        watcher.stop()
+        release.set()
+        self.assertEqual([entry[2] for entry in watcher._schedule], [feed])
+        self.assertTrue(watcher._schedule[0][0] <= clock())
+        time.sleep(0.05)
+        # The poll that finished after stop() did not schedule it twice.
+        self.assertEqual(len(watcher._schedule), 1)
+
+    def test_run(self):
+        self.watcher.watch(Entity.Tasks, interval=0.01)
+        self.watcher.start()
+        try:
+            for i in range(100):
+                if len(self.queries) >= 2:
+                    break
+                time.sleep(0.01)
+            self.tasks['task3'] = {'id': 'task3',
+                                   'modified': '2014-09-21T00:00:00'}
+            for i in range(100):
+                if self.events:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.watcher.stop()
+        self.assertEqual(self.events[0].kind, 'created')
+        self.assertEqual(self.events[0].object['id'], 'task3')
+
+
+@httpretty.activate
+class TestCounts(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        self.queries = []
+
+        def respond(request, uri, headers):
+            self.queries.append(request.querystring)
+            mime_types = request.querystring.get('mime_type')
+            objects = [obj for obj in all_files()
+                       if not mime_types or obj['mime_type'] in mime_types]
+            limit = int(request.querystring['limit'][0])
+            body = {'meta': {'next': None, 'total_count': len(objects)},
+                    'objects': objects[:limit]}
+            return 200, headers, json.dumps(body)
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=respond,
+            content_type="application/json; charset=utf-8")
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+
+    def test_count(self):
+        self.assertEqual(self.client.count(Entity.Files), 45)
+        self.assertEqual(self.queries[0]['limit'], ['1'])
+        self.assertEqual(self.client.count(
+            Entity.Files, {'mime_type': 'application/pdf'}), 22)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_count_is_cached(self):
+        self.client.count(Entity.Files, {'mime_type': 'application/pdf'})
+        self.client.count(Entity.Files, {'mime_type': 'application/pdf'})
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(self.client.stats['count_cache_hits'], 1)
+        self.client.count_ttl = 0
+        self.client._counts.clear()
+        self.client.count(Entity.Files, {'mime_type': 'application/pdf'})
+        self.client.count(Entity.Files, {'mime_type': 'application/pdf'})
+        self.assertEqual(len(self.queries), 3)
+
+    def test_expired_counts_are_dropped(self):
+        self.client.count_ttl = 0.05
+        self.client._counts['old'] = (1, clock() - 1)
+        time.sleep(0.05)
+        self.client.count(Entity.Files)
+        self.assertEqual(len(self.client._counts), 1)
+        self.assertNotIn('old', self.client._counts)
+
+    def test_facets(self):
+        counts = self.client.facets(
+            Entity.Files, 'mime_type', ['application/pdf', 'text/plain'],
+            search_terms={'space': 'derp'})
+        self.assertEqual(counts, {'application/pdf': 22, 'text/plain': 0})
+        self.assertEqual(len(self.queries), 2)
+        self.assertTrue(all(query['space'] == ['derp']
+                            for query in self.queries))
+
+    def test_aggregate(self):
+        counts = self.client.aggregate(Entity.Files, {
+            'all': {}, 'pdf': {'mime_type': 'application/pdf'}})
+        self.assertEqual(counts, {'all': 45, 'pdf': 22})
+
+
+@httpretty.activate
+class TestEditChanges(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/file1/'
+
+    def setUp(self):
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+        self.original = {'id': 'file1', 'title': 'Report', 'tags': ['a'],
+                         'aspects': {'large': 'x' * 1000}}
+        self.modified = dict(self.original, tags=['a', 'b'])
+        del self.modified['title']
+
+    def test_changed_fields(self):
+        self.assertEqual(
+            Utils.changed_fields(self.original, self.modified),
+            {'tags': ['a', 'b'], 'title': None})
+        self.assertEqual(Utils.changed_fields(self.original,
+                                              dict(self.original)), {})
+        # Interned objects hold tuples where the edited copy has lists.
+        interned = dict(self.original, tags=('a',),
+                        aspects={'large': 'x' * 1000, 'parts': (('b',),)})
+        self.assertEqual(Utils.changed_fields(
+            interned, dict(self.original, aspects={
+                'large': 'x' * 1000, 'parts': [['b']]})), {})
+
+    def test_patch(self):
+        httpretty.register_uri(httpretty.PATCH, self.url, status=202)
+        changes = self.client.edit_changes(
+            Entity.Files, 'file1', self.original, self.modified)
+        self.assertEqual(changes, {'tags': ['a', 'b'], 'title': None})
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'PATCH')
+        self.assertEqual(json.loads(request.body.decode('utf-8')), changes)
+        self.assertTrue(self.client.supports_patch)
+
+    def test_falls_back_to_partial_put(self):
+        httpretty.register_uri(httpretty.PATCH, self.url, status=405)
+        httpretty.register_uri(httpretty.PUT, self.url, status=204)
+        self.client.edit_changes(
+            Entity.Files, 'file1', self.original, self.modified)
+        self.assertFalse(self.client.supports_patch)
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'PUT')
+        self.assertEqual(json.loads(request.body.decode('utf-8')),
+                         {'tags': ['a', 'b'], 'title': None})
+        # PATCH is not tried again.
+        httpretty.register_uri(
+            httpretty.PATCH, self.url, status=500,
+            body=json.dumps({'error_message': 'Nope'}))
+        self.client.edit_changes(
+            Entity.Files, 'file1', self.original, {'id': 'file1'})
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'PUT')
+        self.assertEqual(json.loads(request.body.decode('utf-8')),
+                         {'title': None, 'tags': None, 'aspects': None})
+
+    def test_skips_unchanged(self):
+        changes = self.client.edit_changes(
+            Entity.Files, 'file1', self.original, dict(self.original))
+        self.assertEqual(changes, {})
+        self.assertFalse(httpretty.latest_requests())
+        self.assertEqual(self.client.stats['edits_skipped'], 1)
+
+    def test_error(self):
+        httpretty.register_uri(
+            httpretty.PATCH, self.url, status=500,
+            body=json.dumps({'error_message': 'Nope'}))
+        with self.assertRaises(CoredataError):
+            self.client.edit_changes(
+                Entity.Files, 'file1', self.original, self.modified)
+
+    def test_refused(self):
+        httpretty.register_uri(httpretty.PATCH, self.url, status=403)
+        with self.assertRaises(CoredataError):
+            self.client.edit_changes(
+                Entity.Files, 'file1', self.original, self.modified)
+        httpretty.register_uri(httpretty.PATCH, self.url, status=405)
+        httpretty.register_uri(httpretty.PUT, self.url, status=404)
+        with self.assertRaises(CoredataError):
+            self.client.edit_changes(
+                Entity.Files, 'file1', self.original, self.modified)
+
+
+@httpretty.activate
+class TestProfile(TestCase):
+    host = 'https://example.coredata.is'
+    url = host + '/api/v2/files/'
+
+    def setUp(self):
+        httpretty.register_uri(
+            httpretty.GET, self.url, body=listing_callback(all_files()),
+            content_type="application/json; charset=utf-8")
+        self.client = CoredataClient(
+            host=self.host, auth=('username', 'password'))
+
+    def test_get(self):
+        with self.client.profile(slowest=2) as profile:
+            self.assertEqual(len(self.client.get(Entity.Files)), 45)
+        self.assertNotIsInstance(self.client.profiler, Profile)
+        report = profile.report()
+        phases = dict((phase['name'], phase) for phase in report['phases'])
+        self.assertEqual(sorted(phases), ['decode', 'network', 'url'])
+        self.assertEqual(phases['network']['calls'], 3)
+        self.assertEqual(len(report['pages']), 3)
+        self.assertEqual(len(report['slowest']), 2)
+        self.assertTrue(report['slowest'][0]['url'].startswith(self.url))
+        self.assertIsNone(report['peak_memory'])
+        self.assertIn('network', profile.summary())
+
+    def test_iter_objects(self):
+        with self.client.profile() as profile:
+            for obj in self.client.iter_objects(Entity.Files):
+                time.sleep(0.001)
+        phases = dict((phase['name'], phase)
+                      for phase in profile.report()['phases'])
+        self.assertEqual(phases['callback']['calls'], 45)
+        self.assertTrue(phases['callback']['wall'] >= 0.045)
+        walls = [phase['wall'] for phase in profile.report()['phases']]
+        self.assertEqual(walls, sorted(walls, reverse=True))
+
+    def test_trace_memory(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise SkipTest('tracemalloc is not available')
+        with self.client.profile(trace_memory=True) as profile:
+            self.client.get_page(Entity.Files)
+        self.assertFalse(tracemalloc.is_tracing())
+        page, = profile.report()['pages']
+        self.assertTrue(page['peak_memory'] > 0)
+        self.assertIsInstance(page['allocations'], list)
+        self.assertIn('peak memory', profile.summary())